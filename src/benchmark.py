@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+from create_database import (
+    MESES, dump_files, read_dump, parse_df, parse_dumps, df_to_parquet, parquet_to_series, parquet_to_normalized, database_metadata, save_metadata,
+    stream_database,
+)
+
+# benchmarks of the ingestion (create_database.py) and of the query paths of the data analysis app
+# every scale runs over synthetic dumps built from the ones in data/ (1x, 10x and 100x its size by default, no network):
+# copy i of each dump gets its own month (cycling over the months known by the parser) and its prices
+# scaled by a small factor
+# the scales up to --em-memoria are built step by step with the whole database in memory, the bigger ones are
+# built and timed as a whole by stream_database (the --stream mode), whose memory is bounded by the chunk size
+# the results are written as json, so they can be compared across versions
+# note: run from repo root, like the other executables
+#
+#   $ python src/benchmark.py --saida bench.json
+
+DIR_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_analysis')
+
+def bench(func, arg, repeticoes):
+    """
+    Returns the best time (in seconds) of repeticoes runs of func(arg)
+    """
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        func(arg)
+        tempos.append(time.perf_counter() - inicio)
+    return min(tempos)
+
+
+def resultado(escala, etapa, segundos, itens=None, unidade='rows'):
+    registro = {'escala': escala, 'etapa': etapa, 'segundos': round(segundos, 6)}
+    if itens is not None:
+        registro.update(itens=itens, unidade=unidade, por_segundo=round(itens / segundos, 1) if segundos else None)
+    return registro
+
+
+# ------------------------ SYNTHETIC DATA ------------------------
+
+def formata_reais(valores):
+    # 17467.0 -> 'R$ 17.467,00'
+    return ['R$ ' + f'{valor:,.2f}'.replace(',', '_').replace('.', ',').replace('_', '.') for valor in valores]
+
+def gera_dumps(origem, destino, escala):
+    """
+    Writes escala copies of each dump of origem into destino, returns (rows, bytes) written
+    """
+    os.makedirs(destino, exist_ok=True)
+    meses = list(MESES)
+    linhas = 0
+    for file in dump_files(origem):
+        dump = pd.read_csv(f'{origem}/{file}', sep=';')
+        valores = dump['valor'].str.replace('R$', '').str.replace('.', '').str.replace(',', '.').astype('float64').to_numpy()
+        for copia in range(escala):
+            dump['mes_ref'] = meses[copia % len(meses)]
+            dump['valor'] = formata_reais(np.round(valores * (1 + 0.001 * copia)))
+            dump.to_csv(f'{destino}/{copia:03d}-{file}', sep=';', index=False)
+            linhas += len(dump)
+    tamanho = sum(os.path.getsize(f'{destino}/{file}') for file in dump_files(destino))
+    return linhas, tamanho
+
+
+# ------------------------ INGESTION ------------------------
+
+def bench_ingestao(dir, escala, repeticoes):
+    """
+    Times the steps of create_database.py over the dumps in dir, leaving the database (csv, parquet, time series,
+    normalized tables and metadata) in dir for the query benchmarks
+    """
+    resultados = []
+
+    inicio = time.perf_counter()
+    dumps = [(read_dump(f'{dir}/{file}'), file) for file in dump_files(dir)]
+    linhas = sum(len(df) for df, _ in dumps)
+    resultados.append(resultado(escala, 'read_dump', time.perf_counter() - inicio, linhas))
+
+    segundos = bench(lambda dumps: [parse_df(df, file) for df, file in dumps], dumps, repeticoes)
+    resultados.append(resultado(escala, 'parse_df', segundos, linhas))
+    del dumps
+
+    # whole read + parse of create_database.py, checked against the chunked reader of --stream
+    inicio = time.perf_counter()
+    final_df, _ = parse_dumps(dir)
+    resultados.append(resultado(escala, 'parse_dumps', time.perf_counter() - inicio, len(final_df)))
+    chunks = [parse_df(chunk, file)[0] for file in dump_files(dir) for chunk in read_dump(f'{dir}/{file}', 100_000)]
+    assert pd.concat(chunks, ignore_index=True).equals(final_df), 'whole and chunked reads produced different outputs'
+    del chunks
+
+    inicio = time.perf_counter()
+    final_df.to_csv(f'{dir}/database.csv', sep=';')
+    resultados.append(resultado(escala, 'to_csv', time.perf_counter() - inicio, len(final_df)))
+
+    inicio = time.perf_counter()
+    df_to_parquet(final_df, f'{dir}/database.parquet')
+    resultados.append(resultado(escala, 'df_to_parquet', time.perf_counter() - inicio, len(final_df)))
+
+    inicio = time.perf_counter()
+    parquet_to_series(f'{dir}/database.parquet', f'{dir}/series')
+    resultados.append(resultado(escala, 'parquet_to_series', time.perf_counter() - inicio, len(final_df)))
+
+    inicio = time.perf_counter()
+    parquet_to_normalized(f'{dir}/database.parquet', f'{dir}/normalized')
+    resultados.append(resultado(escala, 'parquet_to_normalized', time.perf_counter() - inicio, len(final_df)))
+    save_metadata(database_metadata(final_df), f'{dir}/metadata.json')
+
+    return resultados
+
+
+def bench_stream(dir, escala, chunksize):
+    """
+    Times the --stream build of create_database.py over the dumps in dir, in a fresh interpreter (so its peak
+    memory is not mixed with the one of the benchmark), leaving the database in dir for the query benchmarks
+    """
+    saida = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--stream', str(escala), '--chunksize', str(chunksize), dir],
+        capture_output=True, text=True, check=True,
+    )
+    # stream_database prints its own messages, the results are the last line
+    return json.loads(saida.stdout.strip().splitlines()[-1])
+
+def stream(dir, escala, chunksize):
+    """
+    Build of bench_stream, run inside its subprocess
+    """
+    inicio = time.perf_counter()
+    linhas = stream_database(dir, f'{dir}/database.csv', f'{dir}/database.parquet', f'{dir}/metadata.json',
+                             f'{dir}/series', f'{dir}/normalized', f'{dir}/rejects.csv', chunksize)
+    registro = resultado(escala, 'stream_database', time.perf_counter() - inicio, linhas)
+    # ru_maxrss is in KiB on linux
+    registro['pico_rss_mib'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    return [registro]
+
+
+# ------------------------ QUERIES ------------------------
+
+def bench_consultas(dir, escala):
+    """
+    Runs the query benchmarks in a fresh interpreter (so the load of the app is really cold),
+    inside the app directory (like `shiny run`) and with the app pointed to the database in dir
+    """
+    env = dict(os.environ, FIPE_DATA=os.path.abspath(dir))
+    saida = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--consultas', str(escala)],
+        cwd=DIR_APP, env=env, capture_output=True, text=True, check=True,
+    )
+    # the app prints its own messages, the results are the last line
+    return json.loads(saida.stdout.strip().splitlines()[-1])
+
+def consultas(escala):
+    """
+    Query benchmarks, run inside the subprocess of bench_consultas
+    """
+    resultados = []
+    sys.path.insert(0, DIR_APP)
+
+    inicio = time.perf_counter()
+    import app
+    resultados.append(resultado(escala, 'app_cold_load', time.perf_counter() - inicio))
+
+    from cube import Filtros
+    from busca import ModeloBusca
+    from historico import modelos_por_ano_fab
+    import graficos
+
+    anos_ref = app.metadata['anos_ref']
+    # brands are matched exactly: names that are not in the database would silently shrink the case
+    marcas = ('Fiat', 'VW - VolksWagen', 'GM - Chevrolet')
+    assert set(marcas) <= set(app.metadata['marcas']), 'brands of the benchmark are not in the database'
+    # representative filter combinations: default view, old years, models, every optional filter, real prices
+    filtros = []
+    for ano_ref in sorted({anos_ref[0], anos_ref[len(anos_ref) // 2], anos_ref[-1]}):
+        for ano_fab in (ano_ref, ano_ref - 5, ano_ref - 15):
+            for analise in ('marca', 'modelo'):
+                base = Filtros(ano_ref, ano_fab, analise, True, 10, ('g', 'a', 'd', 'e'), ('m', 'a'))
+                filtros += [
+                    base,
+                    base._replace(decrescente=False, combustivel=('g',), cambio=('a',)),
+                    base._replace(tam_motor=(1.0, 2.0)),
+                    base._replace(tipo_motor=('V8', 'V6')),
+                    base._replace(marcas=marcas),
+                    base._replace(real=True),
+                ]
+
+    # cold: includes reading the partitions and building the cubes of each ano_ref
+    for etapa in ('ranking_cold', 'ranking_warm'):
+        inicio = time.perf_counter()
+        for filtro in filtros:
+            app.calcula_ranking(filtro)
+        resultados.append(resultado(escala, etapa, time.perf_counter() - inicio, len(filtros), 'queries'))
+
+    # history plot of sampled models of the latest year (load of the history + png render)
+    atual = app.particoes.ano(anos_ref[-1], ['modelo', 'ano_fab'])
+    amostra = atual.sample(min(20, len(atual)), random_state=0)
+    pares = list(zip(amostra['modelo'].astype(str), amostra['ano_fab'].astype(int)))
+    inicio = time.perf_counter()
+    historicos = [app.carrega_historico(modelo, ano_fab) for modelo, ano_fab in pares]
+    resultados.append(resultado(escala, 'historico_load', time.perf_counter() - inicio, len(pares), 'plots'))
+    inicio = time.perf_counter()
+    for (modelo, _), historico in zip(pares, historicos):
+        graficos.render_historico(historico, modelo)
+    resultados.append(resultado(escala, 'historico_render', time.perf_counter() - inicio, len(pares), 'plots'))
+
+    # 'Por Veículo' dropdown: building the search and answering what the user types
+    inicio = time.perf_counter()
+    busca = ModeloBusca(modelos_por_ano_fab(app.particoes.ano(anos_ref[-1], ['ano_ref', 'ano_fab', 'modelo'])))
+    resultados.append(resultado(escala, 'modelo_busca_build', time.perf_counter() - inicio, len(busca.nomes), 'models'))
+    termos = ['g', 'go', 'gol', 'gol 1.0', 'civic', 'flex', 'aut', 'xyz']
+    inicio = time.perf_counter()
+    for ano_fab in (anos_ref[-1], anos_ref[-1] - 10):
+        for termo in termos:
+            busca.buscar(termo, ano_fab)
+    resultados.append(resultado(escala, 'modelo_busca_query', time.perf_counter() - inicio, 2 * len(termos), 'queries'))
+
+    return resultados
+
+
+def versao():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of create_database.py and of the data analysis app')
+    parser.add_argument('--escalas', type=int, nargs='+', default=[1, 10, 100],
+                        help='sizes of the synthetic datasets, in multiples of data/ (default: 1 10 100)')
+    parser.add_argument('--em-memoria', type=int, default=10,
+                        help='biggest scale built in memory, the bigger ones are built by stream_database (default: 10)')
+    parser.add_argument('--chunksize', type=int, default=100_000, help='rows per chunk of stream_database (default: 100000)')
+    parser.add_argument('--repeticoes', type=int, default=3, help='runs of each step, the best one is kept (default: 3)')
+    parser.add_argument('--saida', default=None, help='json file with the results (default: stdout)')
+    parser.add_argument('--consultas', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--stream', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('dir', nargs='?', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.consultas is not None:
+        print(json.dumps(consultas(args.consultas)))
+        raise SystemExit
+    if args.stream is not None:
+        print(json.dumps(stream(args.dir, args.stream, args.chunksize)))
+        raise SystemExit
+
+    resultados = []
+    for escala in args.escalas:
+        dir = tempfile.mkdtemp(prefix=f'fipe-bench-{escala}x-')
+        try:
+            linhas, tamanho = gera_dumps('data', dir, escala)
+            print(f'{escala}x: {linhas} rows, {tamanho / 2**20:.0f} MiB of dumps', file=sys.stderr)
+            if escala <= args.em_memoria:
+                # the big scales run each step once
+                repeticoes = args.repeticoes if escala == 1 else 1
+                resultados += bench_ingestao(dir, escala, repeticoes)
+            else:
+                resultados += bench_stream(dir, escala, args.chunksize)
+            resultados += bench_consultas(dir, escala)
+        finally:
+            shutil.rmtree(dir)
+
+    relatorio = {
+        'versao': versao(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'maquina': platform.platform(),
+        'cpus': os.cpu_count(),
+        'resultados': resultados,
+    }
+    texto = json.dumps(relatorio, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as file:
+            file.write(texto)
+    else:
+        print(texto)
@@ -1,123 +1,820 @@
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import os
 import re
+import json
+import itertools
+import hashlib
+import shutil
+import argparse
+import resource
+import time
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
-# note: append every file that is not an error 
-def csvs_to_df(dir):
-    files = os.listdir(dir)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_analysis'))
+from metadados import database_metadata, merge_metadata
+
+# files inside data/ that are not fipe dumps
+NOT_DUMPS = ["ref.json", "database.csv", "database.parquet", "manifest.json", "metadata.json", "series", "normalized", "rejects.csv"]
+
+def dump_files(dir):
+    """
+    Lists the fipe dumps inside dir (every file that is not an error or a generated file)
+    """
+    return [file for file in os.listdir(dir) if file not in NOT_DUMPS and 'erro' not in file.lower()]
+
+
+# ------------------------ TYPED PARSING ------------------------
+
+# months and fuels as written in the dumps
+MESES = {
+    'janeiro': 1, 'fevereiro': 2, 'março': 3, 'abril': 4, 'maio': 5, 'junho': 6,
+    'julho': 7, 'agosto': 8, 'setembro': 9, 'outubro': 10, 'novembro': 11, 'dezembro': 12,
+}
+COMBUSTIVEIS = {'Gasolina': 'g', 'Álcool': 'a', 'Diesel': 'd'}
+
+# columns of the dumps written by fipe_api.js
+COLUNAS_DUMP = ['ano_ref', 'mes_ref', 'marca', 'modelo', 'ano_fab', 'valor', 'combustivel', 'codigo_fipe']
+
+# types of the parsed frame: every chunk gets the same types, whatever values it has
+SCHEMA = {
+    'ano_ref': 'int64',
+    'mes_ref': 'int64',
+    'marca': str,
+    'modelo': str,
+    'ano_fab': 'int64',
+    'valor': 'float64',
+    'combustivel': str,
+    'codigo_fipe': 'int64',
+    'cambio': str,
+    'tam_motor': 'float64',
+}
+
+# patterns of the raw values (matched against the whole field)
+PADRAO_ANO_REF = re.compile(r'\d{4}')
+# zero km vehicles are priced with ano_fab 32000
+PADRAO_ANO_FAB = re.compile(r'\d{4}|32000')
+PADRAO_VALOR = re.compile(r'R\$ ?\d{1,3}(?:\.\d{3})*,\d{2}')
+PADRAO_CODIGO_FIPE = re.compile(r'\d{6}-\d')
+
+# patterns searched in the model name
+PADRAO_ELETRICO = re.compile(r'Elétrico')
+# semi auto were included in automatico
+PADRAO_CAMBIO = re.compile(r'Aut\.')
+PADRAO_TAM_MOTOR = re.compile(r'(\d+\.\d+)')
+
+# rows that can't be parsed are written here, with the file, the line and the invalid columns
+REJECTS = 'rejects.csv'
+COLUNAS_REJECTS = ['arquivo', 'linha', 'motivo'] + COLUNAS_DUMP
+
+
+def read_dump(path, chunksize=None):
+    """
+    Reads a dump as text (no type inference: the types come from parse_df), as a frame or, if chunksize is given,
+    an iterator of frames of at least chunksize lines (but the last one). Every row keeps its line in the file
+    ('linha') and its number of fields ('campos'): lines with a wrong number of fields are kept too (the extra
+    fields joined into the last column), so parse_df rejects them instead of the reader dropping them.
+    Empty lines are skipped
+    """
+    with open(path, encoding='utf-8', newline='') as file:
+        colunas = file.readline().rstrip('\r\n').split(';')
+    # (line, text) of the lines with a wrong number of fields: the reader hands them over and skips them
+    ruins = []
+    # the line numbers are only given by the reader when it runs in a single thread
+    leitor = pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(use_threads=False),
+        parse_options=pa_csv.ParseOptions(
+            delimiter=';', quote_char=False, ignore_empty_lines=False,
+            invalid_row_handler=lambda linha: ruins.append((linha.number, linha.text)) or 'skip',
+        ),
+        convert_options=pa_csv.ConvertOptions(column_types=dict.fromkeys(colunas, pa.string()), strings_can_be_null=False),
+    )
+    chunks = dump_chunks(leitor, colunas, ruins, chunksize)
+    return chunks if chunksize is not None else next(chunks)
+
+def dump_chunks(leitor, colunas, ruins, chunksize):
+    # rows of the reader and lines handed over already in a chunk
+    lidas = entregues = 0
+    lotes = []
+    for lote in itertools.chain(leitor, [None]):
+        if lote is not None:
+            lotes.append(lote)
+            if chunksize is None or sum(len(lote) for lote in lotes) < chunksize:
+                continue
+        # an empty dump still gives an (empty) frame
+        elif not lotes and lidas:
+            break
+        df = pa.Table.from_batches(lotes, schema=leitor.schema).to_pandas()
+        chunk, entregues = dump_frame(df, colunas, ruins, lidas, entregues, final=lote is None)
+        yield chunk
+        lidas += len(df)
+        lotes = []
+    # lines handed over after the last rows
+    if len(ruins) > entregues:
+        yield dump_frame(pd.DataFrame(columns=colunas, dtype=str), colunas, ruins, lidas, entregues, final=True)[0]
+
+def dump_frame(df, colunas, ruins, lidas, entregues, final):
+    """
+    Adds the line and the number of fields to the rows of a chunk (the first one being row lidas of the reader),
+    with the lines of wrong number of fields handed over since ruins[entregues] that come before its last row (every
+    one of them in the final chunk: the reader hands over the lines of the next block before its rows).
+    Returns the chunk and the number of lines handed over up to it
+    """
+    # the lines are numbered from 2 (the header is line 1), and the ones handed over have no row
+    numeros = np.array([numero for numero, _ in ruins], dtype='int64')
+    posicoes = lidas + np.arange(len(df))
+    df['linha'] = posicoes + 2 + np.searchsorted(numeros - 2 - np.arange(len(numeros)), posicoes, side='right')
+    df['campos'] = len(colunas)
+    limite = df['linha'].iloc[-1] if len(df) and not final else np.inf
+    # an empty line is a row with every field empty
+    df = df[(df[colunas] != '').any(axis=1).to_numpy()]
+
+    novas = [(numero, texto) for numero, texto in ruins[entregues:] if numero < limite]
+    if novas:
+        campos = [texto.split(';') for _, texto in novas]
+        completos = [valores + [''] * (len(colunas) - len(valores)) for valores in campos]
+        ruim = pd.DataFrame(
+            [valores[:len(colunas) - 1] + [';'.join(valores[len(colunas) - 1:])] for valores in completos],
+            columns=colunas, dtype=str,
+        )
+        ruim['linha'] = [numero for numero, _ in novas]
+        ruim['campos'] = [len(valores) for valores in campos]
+        df = pd.concat([df, ruim], ignore_index=True).sort_values('linha', ignore_index=True)
+    return df.reset_index(drop=True), entregues + len(novas)
+
+def parse_df(df, arquivo=''):
+    """
+    Validates and converts the columns of a dump read by read_dump, in a single pass over each column.
+    Returns (parsed, rejects): the valid rows with the types of SCHEMA (plus cambio and tam_motor, extracted
+    from the model name) and the raw invalid rows, in the format of COLUNAS_REJECTS
+    """
+    linha = df['linha'].to_numpy()
+    invalidas = {'campos': (df['campos'] != len(COLUNAS_DUMP)).to_numpy()}
+    df = df.reindex(columns=COLUNAS_DUMP)
+
+    def texto(coluna):
+        return df[coluna].fillna('').str.strip()
+
+    def numero(valores):
+        # through arrow floats: casting the strings straight to numpy goes through python objects
+        return valores.astype('float64[pyarrow]').to_numpy('float64', na_value=np.nan)
+
+    def mapeia(valores, mapa):
+        # the dumps repeat a few values (months, fuels), so only the unique ones are looked up
+        codigos, unicos = pd.factorize(valores)
+        return pd.Series(pd.Series(unicos, dtype=object).map(mapa).to_numpy()[codigos], index=valores.index)
+
+    def inteiro(coluna, padrao):
+        valores = texto(coluna)
+        invalidas[coluna] = ~valores.str.fullmatch(padrao)
+        return numero(valores.where(~invalidas[coluna]))
+
+    ano_ref = inteiro('ano_ref', PADRAO_ANO_REF)
+    ano_fab = inteiro('ano_fab', PADRAO_ANO_FAB)
+
+    mes_ref = mapeia(texto('mes_ref'), MESES)
+    invalidas['mes_ref'] = mes_ref.isna()
+
+    for coluna in ['marca', 'modelo']:
+        invalidas[coluna] = texto(coluna) == ''
+
+    valor = texto('valor')
+    invalidas['valor'] = ~valor.str.fullmatch(PADRAO_VALOR)
+    valor = (
+        valor.where(~invalidas['valor'])
+             .str.replace('R$', '', regex=False)
+             .str.replace('.', '', regex=False)
+             .str.replace(',', '.', regex=False)
+             .str.strip()
+    )
+    valor = numero(valor)
+
+    codigo_fipe = texto('codigo_fipe')
+    invalidas['codigo_fipe'] = ~codigo_fipe.str.fullmatch(PADRAO_CODIGO_FIPE)
+    codigo_fipe = numero(codigo_fipe.where(~invalidas['codigo_fipe']).str.replace('-', '', regex=False))
+
+    # the model name drives three columns, so its unique values are searched only once
+    codigos, modelos = pd.factorize(df['modelo'].fillna(''))
+    modelos = pd.Series(modelos, dtype=str)
+    eletrico = modelos.str.contains(PADRAO_ELETRICO).to_numpy()[codigos]
+    cambio = np.where(modelos.str.contains(PADRAO_CAMBIO), 'a', 'm')[codigos]
+    tam_motor = modelos.str.extract(PADRAO_TAM_MOTOR, expand=False).astype('float64').to_numpy()[codigos]
+
+    # electric models are 'e' whatever the fuel of the dump, the other fuels must be known
+    combustivel = mapeia(df['combustivel'], COMBUSTIVEIS).where(~eletrico, 'e')
+    invalidas['combustivel'] = combustivel.isna()
+
+    parsed = pd.DataFrame({
+        'ano_ref': ano_ref,
+        'mes_ref': mes_ref,
+        'marca': df['marca'],
+        'modelo': df['modelo'],
+        'ano_fab': ano_fab,
+        'valor': valor,
+        'combustivel': combustivel,
+        'codigo_fipe': codigo_fipe,
+        'cambio': cambio,
+        'tam_motor': tam_motor,
+    }, index=df.index)
+
+    invalidas = pd.DataFrame(invalidas, index=df.index)[['campos'] + COLUNAS_DUMP]
+    rejeitada = invalidas.any(axis=1).to_numpy()
+
+    rejects = df[rejeitada].copy()
+    # the fields of a line with a wrong number of them are meaningless, only that is reported
+    motivos = [
+        'campos' if invalidas_linha[0] else ','.join(invalidas.columns[invalidas_linha])
+        for invalidas_linha in invalidas[rejeitada].to_numpy()
+    ]
+    rejects.insert(0, 'motivo', motivos)
+    rejects.insert(0, 'linha', linha[rejeitada])
+    rejects.insert(0, 'arquivo', arquivo)
+
+    return parsed[~rejeitada].astype(SCHEMA), rejects.reset_index(drop=True)
+
+def parse_dumps(dir):
+    """
+    Parses every dump of dir, returns (database, rejects)
+    """
     list_dfs = []
-    for file in files:
-        if file == "ref.json" or file =="database.csv":
+    list_rejects = []
+    for file in dump_files(dir):
+        df, rejects = parse_df(read_dump(f'{dir}/{file}'), file)
+        list_dfs.append(df)
+        list_rejects.append(rejects)
+
+    return pd.concat(list_dfs, ignore_index=True), pd.concat(list_rejects, ignore_index=True)
+
+def save_rejects(rejects, path):
+    rejects[COLUNAS_REJECTS].to_csv(path, sep=';', index=False)
+    if len(rejects):
+        print(f'{len(rejects)} invalid row(s) written to {path}')
+
+
+# ------------------------ INCREMENTAL INGESTION ------------------------
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for bloco in iter(lambda: file.read(1 << 20), b''):
+            sha.update(bloco)
+    return sha.hexdigest()
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def save_manifest(manifest, path):
+    with open(path, 'w') as file:
+        json.dump(manifest, file, indent=2, ensure_ascii=False)
+
+def file_changed(path, entry):
+    """
+    Compares a dump with its manifest entry. The content hash is only computed
+    when size or mtime differ, so untouched files cost a single stat
+    """
+    stat = os.stat(path)
+    if entry is None:
+        return True
+    if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return False
+    if entry['size'] == stat.st_size and entry['sha256'] == file_hash(path):
+        # only touched: keeps the entry up to date and skips the parsing
+        entry['mtime'] = stat.st_mtime
+        return False
+    return True
+
+def read_and_parse(path):
+    """
+    Worker of the process pool: parses a single dump, returns (database, rejects)
+    """
+    return parse_df(read_dump(path), os.path.basename(path))
+
+def manifest_consistent(manifest):
+    # entries written before the rows of each dump were counted (per ano_ref) can't locate them in the database
+    return all('linhas' in entry and 'anos_ref' in entry for entry in manifest.values())
+
+def count_lines(path):
+    with open(path, 'rb') as file:
+        return sum(bloco.count(b'\n') for bloco in iter(lambda: file.read(1 << 20), b''))
+
+def partition_rows(partition):
+    # from the footers of the parquet files, without reading them
+    return sum(pq.ParquetFile(f'{partition}/{nome}').metadata.num_rows for nome in os.listdir(partition))
+
+def database_consistent(manifest, db_path, parquet_path):
+    """
+    Whether the csv and each ano_ref partition have the rows counted in the manifest
+    """
+    if count_lines(db_path) - 1 != sum(entry['linhas'] for entry in manifest.values()):
+        return False
+    por_ano = {}
+    for entry in manifest.values():
+        for ano, linhas in entry['anos_ref'].items():
+            por_ano[int(ano)] = por_ano.get(int(ano), 0) + linhas
+    return por_ano == {ano: partition_rows(partition) for ano, partition in parquet_partitions(parquet_path)}
+
+def rewrite_csv(db_path, manter):
+    """
+    Rewrites the csv database keeping only the rows where manter is True (copied as they are, only their index is
+    renumbered: they are not parsed again)
+    """
+    temporario = f'{db_path}.tmp'
+    with open(db_path, encoding='utf-8', newline='') as origem, open(temporario, 'w', encoding='utf-8', newline='') as destino:
+        destino.write(origem.readline())
+        indice = 0
+        for linha, mantida in zip(origem, manter):
+            if mantida:
+                destino.write(f"{indice};{linha.split(';', 1)[1]}")
+                indice += 1
+    os.replace(temporario, db_path)
+
+def merge_database(dir, db_path, parquet_path, metadata_path, series_path, normalized_path, manifest_path, rejects_path, workers=None):
+    """
+    Parses (in a process pool) only the dumps that are new or changed since the last run, according to the manifest,
+    and merges them into the existing database (and their invalid rows into the existing rejects).
+    The rows of each dump are a contiguous block of the csv and of each of its ano_ref partitions, in the order of the
+    manifest, so the rows of a changed or removed dump are dropped by position (other dumps of the same month are
+    kept) and its new rows are appended. Only the ano_ref partitions of these dumps are rewritten, in the parquet
+    dataset, the time series and the normalized database; the csv is only appended to when no dump changed or was
+    removed. Without a consistent manifest every dump is parsed and the database is written from scratch
+    """
+    inicio = time.perf_counter()
+    manifest = load_manifest(manifest_path)
+    existentes = [db_path, parquet_path, f'{series_path}/series.json', f'{normalized_path}/veiculos.parquet']
+    if not all(os.path.exists(path) for path in existentes) or not manifest_consistent(manifest):
+        manifest = {}
+    files = dump_files(dir)
+
+    changed = [file for file in files if file_changed(f'{dir}/{file}', manifest.get(file))]
+    removed = [file for file in manifest if file not in files]
+    if not changed and not removed:
+        # only touched dumps: their mtimes are kept up to date
+        save_manifest(manifest, manifest_path)
+        print('no dump changed, the database is up to date')
+        return
+
+    if manifest and not database_consistent(manifest, db_path, parquet_path):
+        print(f'the database does not match {manifest_path}, parsing every dump')
+        manifest = {}
+        changed, removed = files, []
+
+    with ProcessPoolExecutor(workers) as pool:
+        novos = dict(zip(changed, pool.map(read_and_parse, [f'{dir}/{file}' for file in changed])))
+    print(f'{len(changed)} dump(s) parsed, {len(files) - len(changed)} unchanged, {len(removed)} removed')
+    lidos = sum(os.path.getsize(f'{dir}/{file}') for file in changed)
+
+    antigo = manifest
+    manifest = {file: entry for file, entry in antigo.items() if file not in changed and file not in removed}
+    # the blocks of the reparsed dumps go to the end of the database
+    for file, (df, _) in novos.items():
+        stat = os.stat(f'{dir}/{file}')
+        manifest[file] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': file_hash(f'{dir}/{file}'),
+            'linhas': len(df),
+            'anos_ref': {str(ano): int(n) for ano, n in df['ano_ref'].value_counts().sort_index().items()},
+        }
+    # (only removed dumps: nothing new)
+    novo_df = pd.concat([df for df, _ in novos.values()] + [pd.DataFrame(columns=list(SCHEMA)).astype(SCHEMA)], ignore_index=True)
+    novos_rejects = pd.concat([rejects for _, rejects in novos.values()] + [pd.DataFrame(columns=COLUNAS_REJECTS)], ignore_index=True)
+
+    if not antigo:
+        write_database(novo_df, novos_rejects, db_path, parquet_path, metadata_path, series_path, normalized_path, rejects_path)
+        save_manifest(manifest, manifest_path)
+        report(len(novo_df), lidos, time.perf_counter() - inicio)
+        return
+
+    # rows of the old database dropped: the blocks of the changed and removed dumps
+    trocados = [file for file in antigo if file in changed or file in removed]
+    anos = sorted({int(ano) for file in trocados for ano in antigo[file]['anos_ref']} | set(novo_df['ano_ref'].unique().tolist()))
+
+    # csv
+    if trocados:
+        manter = np.concatenate([np.full(entry['linhas'], file not in trocados) for file, entry in antigo.items()])
+        rewrite_csv(db_path, manter)
+    linhas = sum(entry['linhas'] for file, entry in antigo.items() if file not in trocados)
+    novo_df.index = pd.RangeIndex(linhas, linhas + len(novo_df))
+    novo_df.to_csv(db_path, sep=';', mode='a', header=False)
+
+    # ano_ref partitions of the parquet dataset
+    for ano in anos:
+        partition = f'{parquet_path}/ano_ref={ano}'
+        blocos = [novo_df[novo_df['ano_ref'] == ano]]
+        if os.path.exists(partition):
+            existente = pd.read_parquet(partition)
+            # the partition column is not stored in the files
+            existente.insert(len(existente.columns), 'ano_ref', ano)
+            manter = np.concatenate([np.full(entry['anos_ref'].get(str(ano), 0), file not in trocados) for file, entry in antigo.items()])
+            blocos.insert(0, existente[manter].astype(novo_df.dtypes.to_dict()))
+            shutil.rmtree(partition)
+        partition_df = pd.concat(blocos, ignore_index=True)
+        if len(partition_df):
+            append_parquet(partition_df, parquet_path)
+
+    update_series(parquet_path, series_path, anos)
+    update_normalized(parquet_path, normalized_path, anos)
+    # bounds and brands of every partition (only the columns they need are read)
+    metadata = None
+    for ano_ref, partition in parquet_partitions(parquet_path):
+        df = pd.read_parquet(partition, columns=['ano_fab', 'marca', 'tam_motor']).assign(ano_ref=ano_ref)
+        metadata = merge_metadata(metadata, database_metadata(df))
+    save_metadata(metadata, metadata_path)
+
+    rejects = pd.read_csv(rejects_path, sep=';', dtype=str, keep_default_na=False) if os.path.exists(rejects_path) else None
+    rejects = pd.concat([rejects[~rejects['arquivo'].isin(trocados)], novos_rejects], ignore_index=True) if rejects is not None else novos_rejects
+    save_rejects(rejects, rejects_path)
+
+    save_manifest(manifest, manifest_path)
+    report(len(novo_df), lidos, time.perf_counter() - inicio)
+
+
+# ------------------------ COLUMNAR DATABASE ------------------------
+
+# types of the columnar database (the remaining columns keep the types of the transform)
+PARQUET_TYPES = {
+    'marca': 'category',
+    'modelo': 'category',
+    'combustivel': 'category',
+    'cambio': 'category',
+    'valor': 'float32',
+    'tam_motor': 'float32',
+}
+
+def df_to_parquet(df, path):
+    """
+    Writes the database as a zstd compressed parquet dataset partitioned by ano_ref
+    (one directory per year: path/ano_ref=2023/...), used by the data analysis app
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    append_parquet(df, path)
+
+def append_parquet(df, path):
+    """
+    Adds the rows of df to the dataset (as new files inside the ano_ref partitions)
+    """
+    df.astype(PARQUET_TYPES).to_parquet(path, partition_cols=['ano_ref'], compression='zstd', index=False)
+
+
+# ------------------------ METADATA ------------------------
+
+# the bounds and brands written to data/metadata.json come from the same functions the app uses (data_analysis/metadados.py)
+
+def save_metadata(metadata, path):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(metadata, file, indent=2, ensure_ascii=False)
+
+
+# ------------------------ TIME SERIES ------------------------
+
+# key of a vehicle (the same codigo_fipe and ano_fab is priced once per fuel)
+SERIES_CHAVES = ['codigo_fipe', 'ano_fab', 'combustivel']
+# a price series per vehicle and name, like the vehicles of the normalized database (the few vehicles renamed by fipe
+# keep a series per name), sorted by name so the series of a model are next to each other
+SERIES_ORDEM = ['modelo', 'ano_fab', 'combustivel', 'codigo_fipe', 'marca']
+
+def parquet_partitions(path):
+    """
+    (ano_ref, directory) of every partition of the parquet dataset, sorted by ano_ref
+    """
+    partitions = [(int(nome.split('=')[1]), f'{path}/{nome}') for nome in os.listdir(path) if nome.startswith('ano_ref=')]
+    return sorted(partitions)
+
+def series_keys(df):
+    """
+    Key (SERIES_ORDEM) of the series of every row of df
+    """
+    return df[SERIES_ORDEM].astype({coluna: str for coluna in ['modelo', 'combustivel', 'marca']})
+
+def series_observations(partition, ano_ref, ano_inicio, indice):
+    """
+    (row of the series, month, price) of every price of a partition, sorted by row and month
+    (every row of the database is kept, like in the histories read from it)
+    """
+    df = pd.read_parquet(partition, columns=SERIES_ORDEM + ['mes_ref', 'valor'])
+    obs = pd.DataFrame({
+        'linha': indice.get_indexer(pd.MultiIndex.from_frame(series_keys(df))),
+        'periodo': (ano_ref - ano_inicio) * 12 + df['mes_ref'].to_numpy().astype('int64') - 1,
+        'valor': df['valor'].to_numpy().astype('float32'),
+    })
+    return obs.sort_values(['linha', 'periodo'], kind='stable', ignore_index=True)
+
+def parquet_to_series(parquet_path, series_path):
+    """
+    Writes the time series store read by the data analysis app (data_analysis/series.py), with only the observed
+    months of each series (most vehicles are priced in a few months of the whole range):
+      - precos.npy, periodos.npy: float32 prices and int16 months (counted from january of the first ano_ref) of every
+        series, one after the other (series by SERIES_ORDEM, sorted; months in order)
+      - inicio.npy: position of the first price of each series in precos/periodos (plus the total at the end)
+      - codigo_fipe.npy, ano_fab.npy, combustivel.npy, marca.npy: the key of each series
+      - series.json: first ano_ref and the series [inicio, fim) of each model name
+    The dataset is read one ano_ref partition at a time (three passes: keys, number of prices, prices), and the
+    prices are written in place into memory-mapped files, so the memory stays bounded like in --stream
+    """
+    partitions = parquet_partitions(parquet_path)
+    ano_inicio = partitions[0][0]
+
+    # 1st pass: keys of every series
+    chaves = []
+    for _, partition in partitions:
+        chaves.append(series_keys(pd.read_parquet(partition, columns=SERIES_ORDEM)).drop_duplicates())
+    chaves = pd.concat(chaves).drop_duplicates().sort_values(SERIES_ORDEM, ignore_index=True)
+    indice = pd.MultiIndex.from_frame(chaves)
+
+    # 2nd pass: number of prices of each series
+    contagem = np.zeros(len(chaves), dtype='int64')
+    for ano_ref, partition in partitions:
+        contagem += np.bincount(series_observations(partition, ano_ref, ano_inicio, indice)['linha'], minlength=len(chaves))
+    inicio = np.concatenate([[0], np.cumsum(contagem)])
+
+    if os.path.exists(series_path):
+        shutil.rmtree(series_path)
+    os.makedirs(series_path)
+    precos = np.lib.format.open_memmap(f'{series_path}/precos.npy', mode='w+', dtype='float32', shape=(int(inicio[-1]),))
+    periodos = np.lib.format.open_memmap(f'{series_path}/periodos.npy', mode='w+', dtype='int16', shape=(int(inicio[-1]),))
+
+    # 3rd pass: prices, appended to each series in the order of the partitions (so the months stay sorted)
+    proximo = inicio[:-1].copy()
+    for ano_ref, partition in partitions:
+        obs = series_observations(partition, ano_ref, ano_inicio, indice)
+        linhas = obs['linha'].to_numpy()
+        # position of each price among the ones of its series in this partition
+        primeiro = np.searchsorted(linhas, linhas, side='left')
+        posicoes = proximo[linhas] + np.arange(len(linhas)) - primeiro
+        precos[posicoes] = obs['valor'].to_numpy()
+        periodos[posicoes] = obs['periodo'].to_numpy()
+        proximo += np.bincount(linhas, minlength=len(chaves))
+    precos.flush()
+    periodos.flush()
+    del precos, periodos
+
+    save_series_keys(series_path, chaves, inicio, ano_inicio)
+
+def save_series_keys(series_path, chaves, inicio, ano_inicio):
+    """
+    Writes the keys and the position of every series of the store (after its prices)
+    """
+    np.save(f'{series_path}/inicio.npy', inicio)
+    np.save(f'{series_path}/codigo_fipe.npy', chaves['codigo_fipe'].to_numpy().astype('int32'))
+    np.save(f'{series_path}/ano_fab.npy', chaves['ano_fab'].to_numpy().astype('int16'))
+    np.save(f'{series_path}/combustivel.npy', chaves['combustivel'].to_numpy().astype(str))
+    np.save(f'{series_path}/marca.npy', chaves['marca'].to_numpy().astype(str))
+    # the series of a model are [inicio, fim)
+    nomes = chaves['modelo'].to_numpy()
+    limites = np.flatnonzero(np.r_[True, nomes[1:] != nomes[:-1], True])
+    modelos = {str(nomes[a]): [int(a), int(b)] for a, b in zip(limites[:-1], limites[1:])}
+    # written last: the app checks it is newer than the parquet
+    with open(f'{series_path}/series.json', 'w', encoding='utf-8') as file:
+        json.dump({'ano_ref_inicio': ano_inicio, 'modelos': modelos}, file, ensure_ascii=False)
+
+def update_series(parquet_path, series_path, anos):
+    """
+    Updates the time series store after the ano_ref partitions in anos were rewritten: the prices of the other years
+    come from the store itself, only these partitions are read
+    """
+    with open(f'{series_path}/series.json', encoding='utf-8') as file:
+        info = json.load(file)
+    inicio = np.load(f'{series_path}/inicio.npy')
+    chaves = pd.DataFrame({
+        'modelo': np.repeat(np.array(list(info['modelos']), dtype=object), [b - a for a, b in info['modelos'].values()]),
+        'ano_fab': np.load(f'{series_path}/ano_fab.npy').astype('int64'),
+        'combustivel': np.load(f'{series_path}/combustivel.npy').astype(object),
+        'codigo_fipe': np.load(f'{series_path}/codigo_fipe.npy').astype('int64'),
+        'marca': np.load(f'{series_path}/marca.npy').astype(object),
+    })[SERIES_ORDEM]
+    # prices of the store, in months since year 0, without the ones of the rewritten partitions
+    obs = pd.DataFrame({
+        'linha': np.repeat(np.arange(len(chaves)), np.diff(inicio)),
+        'periodo': info['ano_ref_inicio'] * 12 + np.load(f'{series_path}/periodos.npy').astype('int64'),
+        'valor': np.load(f'{series_path}/precos.npy'),
+    })
+    obs = obs[~np.isin(obs['periodo'] // 12, anos)]
+
+    partitions = [(ano, partition) for ano, partition in parquet_partitions(parquet_path) if ano in anos]
+    novos = [series_keys(pd.read_parquet(partition, columns=SERIES_ORDEM)) for _, partition in partitions]
+    # keys of the series that still have prices
+    todas = pd.concat([chaves.iloc[np.unique(obs['linha'])]] + novos).drop_duplicates().sort_values(SERIES_ORDEM, ignore_index=True)
+    indice = pd.MultiIndex.from_frame(todas)
+    # old series -> new series (-1 for the ones left without prices)
+    obs['linha'] = indice.get_indexer(pd.MultiIndex.from_frame(chaves))[obs['linha'].to_numpy()]
+    obs = pd.concat([obs] + [
+        series_observations(partition, ano, 0, indice) for ano, partition in partitions
+    ], ignore_index=True).sort_values(['linha', 'periodo'], kind='stable', ignore_index=True)
+
+    ano_inicio = parquet_partitions(parquet_path)[0][0]
+    if os.path.exists(series_path):
+        shutil.rmtree(series_path)
+    os.makedirs(series_path)
+    np.save(f'{series_path}/precos.npy', obs['valor'].to_numpy().astype('float32'))
+    np.save(f'{series_path}/periodos.npy', (obs['periodo'].to_numpy() - ano_inicio * 12).astype('int16'))
+    inicio = np.concatenate([[0], np.cumsum(np.bincount(obs['linha'], minlength=len(todas)))])
+    save_series_keys(series_path, todas, inicio, ano_inicio)
+
+
+# ------------------------ NORMALIZED DATABASE ------------------------
+
+# every monthly dump repeats the names of the same vehicles and only valor changes, so the normalized database
+# stores each vehicle once:
+#   - veiculos.parquet: vehicle dimension, a row per (codigo_fipe, ano_fab, combustivel) and name (the few
+#     vehicles renamed by fipe over time keep a row per name), sorted (the ones added by --incremental are
+#     appended); vehicle_id is the row number
+#   - precos.parquet: fact table (vehicle_id, ano_ref, mes_ref, valor), partitioned by ano_ref like the database
+# the app joins them back (data_analysis/loader.py), reading only the partitions and vehicles it needs
+COLUNAS_VEICULO = SERIES_CHAVES + ['marca', 'modelo', 'cambio', 'tam_motor']
+# key of a row of the dimension
+VEICULO_CHAVES = SERIES_CHAVES + ['marca', 'modelo']
+
+VEICULO_TYPES = {
+    'codigo_fipe': 'int32',
+    'ano_fab': 'int16',
+    'marca': 'category',
+    'modelo': 'category',
+    'combustivel': 'category',
+    'cambio': 'category',
+    'tam_motor': 'float32',
+}
+
+def veiculo_keys(df):
+    # the text columns of each partition are categoricals with their own categories
+    return pd.MultiIndex.from_frame(df[VEICULO_CHAVES].astype({coluna: str for coluna in ['combustivel', 'marca', 'modelo']}))
+
+def write_precos(df, ano_ref, indice, normalized_path):
+    """
+    Writes the prices of a partition of the database into the fact table (indice: keys of the vehicle dimension)
+    """
+    precos = pd.DataFrame({
+        'vehicle_id': indice.get_indexer(veiculo_keys(df)).astype('int32'),
+        'ano_ref': ano_ref,
+        'mes_ref': df['mes_ref'].astype('int8'),
+        'valor': df['valor'].astype('float32'),
+    })
+    precos.to_parquet(f'{normalized_path}/precos.parquet', partition_cols=['ano_ref'], compression='zstd', index=False)
+
+def parquet_to_normalized(parquet_path, normalized_path):
+    """
+    Writes the normalized database (vehicle dimension + fact table of prices) from the parquet dataset,
+    read one ano_ref partition at a time (two passes: vehicles, then prices), so the memory stays bounded like in --stream
+    """
+    partitions = parquet_partitions(parquet_path)
+
+    # 1st pass: vehicles
+    veiculos = []
+    for _, partition in partitions:
+        df = pd.read_parquet(partition, columns=COLUNAS_VEICULO)
+        veiculos.append(df.astype({coluna: str for coluna in ['combustivel', 'marca', 'modelo', 'cambio']}).drop_duplicates(VEICULO_CHAVES))
+    veiculos = pd.concat(veiculos).drop_duplicates(VEICULO_CHAVES).sort_values(VEICULO_CHAVES, ignore_index=True)
+    indice = veiculo_keys(veiculos)
+
+    if os.path.exists(normalized_path):
+        shutil.rmtree(normalized_path)
+    os.makedirs(normalized_path)
+
+    # 2nd pass: prices, in the order of the rows of the database
+    for ano_ref, partition in partitions:
+        write_precos(pd.read_parquet(partition, columns=VEICULO_CHAVES + ['mes_ref', 'valor']), ano_ref, indice, normalized_path)
+
+    # written last: the app checks it is newer than the parquet
+    veiculos.astype(VEICULO_TYPES).to_parquet(f'{normalized_path}/veiculos.parquet', compression='zstd', index=False)
+
+
+def update_normalized(parquet_path, normalized_path, anos):
+    """
+    Updates the normalized database after the ano_ref partitions in anos were rewritten: only their prices are
+    written again, and their new vehicles are appended to the dimension (so the vehicle_id of the others don't change;
+    vehicles left without prices stay in it until the next full build)
+    """
+    veiculos = pd.read_parquet(f'{normalized_path}/veiculos.parquet')
+    veiculos = veiculos.astype({coluna: str for coluna in ['combustivel', 'marca', 'modelo', 'cambio']})
+    for ano_ref in anos:
+        if os.path.exists(f'{normalized_path}/precos.parquet/ano_ref={ano_ref}'):
+            shutil.rmtree(f'{normalized_path}/precos.parquet/ano_ref={ano_ref}')
+        partition = f'{parquet_path}/ano_ref={ano_ref}'
+        if not os.path.exists(partition):
             continue
-        if 'erro' not in file.lower():
-            df = pd.read_csv(f'{dir}/{file}', sep=';')
-            list_dfs.append(df)   
-
-    final_df = pd.concat(list_dfs, ignore_index=True)
-
-    return final_df
-
-
-def transform_df(df):
-    trans_df = df.copy()
-
-    # mes_ref to int
-    trans_df['mes_ref'] = df['mes_ref'].apply(mes_ref_to_int)
-
-    # reais to float
-    trans_df['valor'] = df['valor'].apply(reais_to_float)
-
-    # combustivel add eletrics
-    trans_df.loc[trans_df.modelo.str.contains('Elétrico', regex=True, na=False), "combustivel"] = 'e'
-
-    # combustivel to char
-    trans_df['combustivel'] = trans_df['combustivel'].apply(combustivel_to_char)
-
-
-    # codigo_fipe to int
-    trans_df['codigo_fipe'] = df['codigo_fipe'].apply(codigo_fipe_to_int)
-
-    # add column gear (cambio)
-    trans_df['cambio'] = df['modelo'].apply(extrai_cambio)
-
-    # add column engine size (tamanho do motor)
-    trans_df['tam_motor'] = df['modelo'].apply(extrai_tam_motor)
-        
- 
-    return trans_df
-
-def mes_ref_to_int(mes):
-    if mes == 'janeiro':
-        mes = 1
-    elif mes == 'fevereiro':
-        mes = 2
-    elif mes == 'março':
-        mes = 3
-    elif mes == 'abril':
-        mes = 4
-    elif mes == 'maio':
-        mes = 5
-    elif mes == 'junho':
-        mes = 6
-    elif mes == 'julho':
-        mes = 7
-    elif mes == 'agosto':
-        mes = 8
-    elif mes == 'setembro':
-        mes = 9
-    elif mes == 'outubro':
-        mes = 10
-    elif mes == 'novembro':
-        mes = 11
-    else:
-        mes == 12
-    return mes
-
-def combustivel_to_char(combustivel):
-    if combustivel == 'Gasolina':
-        combustivel = 'g'
-    elif combustivel == 'Álcool':
-        combustivel = 'a'
-    elif combustivel == 'Diesel':
-        combustivel = 'd'
-    return combustivel
-
-def filter_eletrics(df):
-    print(df)
-    match = re.search('Elétrico', df['modelo'])
-    if match:
-        df['combustivel'] = 'e'
-    return
-
-def codigo_fipe_to_int(cod):
-    # 012345-7
-    return int(''.join(cod.split('-')))
-
-
-def reais_to_float(valor):
-    valor = valor.replace('R$', '').replace('.', '').replace(',', '.').strip()
-    return float(valor)
-
-def extrai_cambio(modelo):
-    # semi auto were included in automatico
-    match = re.search(r'Aut\.', modelo)
-    if match:
-        return 'a'
-    else:
-        return 'm' 
-
-def extrai_tam_motor(modelo):
-    match = re.search(r'\d+\.\d+', modelo)
-    if match:
-        tam = match.group()
-        return float(tam)
-    else:
-        return None    
-
-
-dir = 'data'
-df = csvs_to_df(dir)
-final_df = transform_df(df)
-
-# include dir
-final_df.to_csv('data/database.csv', sep=';')
+        df = pd.read_parquet(partition, columns=COLUNAS_VEICULO + ['mes_ref', 'valor'])
+        chaves = veiculo_keys(df)
+        novos = veiculo_keys(veiculos).get_indexer(chaves) == -1
+        if novos.any():
+            novos = df[novos][COLUNAS_VEICULO].astype({coluna: str for coluna in ['combustivel', 'marca', 'modelo', 'cambio']})
+            veiculos = pd.concat([veiculos, novos.drop_duplicates(VEICULO_CHAVES)], ignore_index=True)
+        write_precos(df, ano_ref, veiculo_keys(veiculos), normalized_path)
+
+    # written last: the app checks it is newer than the parquet
+    veiculos.astype(VEICULO_TYPES).to_parquet(f'{normalized_path}/veiculos.parquet', compression='zstd', index=False)
+
+
+# ------------------------ STREAMING ------------------------
+
+def stream_database(dir, db_path, parquet_path, metadata_path, series_path, normalized_path, rejects_path, chunksize=100_000):
+    """
+    Builds the database reading every dump in chunks of chunksize rows: each chunk is parsed and
+    appended to the csv and to the parquet dataset (and its invalid rows to the rejects), so the peak memory
+    depends on chunksize instead of the size of the whole history (the time series are then built one
+    partition at a time). Prints the peak memory and the throughput at the end, returns the number of rows
+    """
+    inicio = time.perf_counter()
+    if os.path.exists(parquet_path):
+        shutil.rmtree(parquet_path)
+
+    linhas = 0
+    lidos = 0
+    rejeitadas = 0
+    metadata = None
+    header = True
+    with open(db_path, 'w', encoding='utf-8', newline='') as db_csv, open(rejects_path, 'w', encoding='utf-8', newline='') as rejects_csv:
+        rejects_csv.write(';'.join(COLUNAS_REJECTS) + '\n')
+        for file in dump_files(dir):
+            lidos += os.path.getsize(f'{dir}/{file}')
+            for chunk in read_dump(f'{dir}/{file}', chunksize):
+                chunk, rejects = parse_df(chunk, file)
+                rejects[COLUNAS_REJECTS].to_csv(rejects_csv, sep=';', header=False, index=False)
+                rejeitadas += len(rejects)
+                # every row of the chunk was rejected
+                if chunk.empty:
+                    continue
+                # same index as the concatenated frame of the in-memory mode
+                chunk.index = pd.RangeIndex(linhas, linhas + len(chunk))
+                chunk.to_csv(db_csv, sep=';', header=header)
+                header = False
+                append_parquet(chunk, parquet_path)
+                metadata = merge_metadata(metadata, database_metadata(chunk))
+                linhas += len(chunk)
+
+    if rejeitadas:
+        print(f'{rejeitadas} invalid row(s) written to {rejects_path}')
+    if not linhas:
+        raise SystemExit(f'no valid row in the dumps of {dir}')
+    parquet_to_series(parquet_path, series_path)
+    parquet_to_normalized(parquet_path, normalized_path)
+    save_metadata(metadata, metadata_path)
+    report(linhas, lidos, time.perf_counter() - inicio)
+    return linhas
+
+def write_database(df, rejects, db_path, parquet_path, metadata_path, series_path, normalized_path, rejects_path):
+    """
+    Writes the whole database (and the stores derived from it) from the parsed dumps
+    """
+    save_rejects(rejects, rejects_path)
+    # include dir
+    df.to_csv(db_path, sep=';')
+    # columnar copy for the data analysis app (the csv is still read by create_binaries.c)
+    df_to_parquet(df, parquet_path)
+    # price series per vehicle, memory-mapped by the app
+    parquet_to_series(parquet_path, series_path)
+    # vehicles stored once + narrow table of prices, joined back by the app
+    parquet_to_normalized(parquet_path, normalized_path)
+    # bounds and brands for the UI of the app (written after the parquet: the app checks it is newer)
+    save_metadata(database_metadata(df), metadata_path)
+
+def report(linhas, lidos, segundos):
+    # ru_maxrss is in KiB on linux
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{linhas} rows in {segundos:.1f} s ({linhas / segundos:,.0f} rows/s, {lidos / 2**20 / segundos:.1f} MiB/s of dumps), '
+          f'peak RSS {pico:.0f} MiB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Formats the extracted data into data/database.csv')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only parse new/changed dumps (tracked in data/manifest.json) and merge them into the existing database')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes used by --incremental (default: number of cpus)')
+    parser.add_argument('--stream', action='store_true',
+                        help='read, transform and write the dumps in chunks, with bounded memory')
+    parser.add_argument('--chunksize', type=int, default=100_000,
+                        help='rows per chunk of --stream (default: 100000)')
+    args = parser.parse_args()
+    if args.stream and args.incremental:
+        parser.error('--stream and --incremental can not be used together')
+
+    dir = 'data'
+    db_path = 'data/database.csv'
+    manifest_path = 'data/manifest.json'
+    rejects_path = f'data/{REJECTS}'
+
+    # the full rebuilds don't track the dumps: the next --incremental run parses all of them
+    if not args.incremental and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    if args.stream:
+        stream_database(dir, db_path, 'data/database.parquet', 'data/metadata.json', 'data/series', 'data/normalized', rejects_path, args.chunksize)
+        raise SystemExit
+
+    if args.incremental:
+        merge_database(dir, db_path, 'data/database.parquet', 'data/metadata.json', 'data/series', 'data/normalized',
+                       manifest_path, rejects_path, args.workers)
+        raise SystemExit
+
+    inicio = time.perf_counter()
+    final_df, rejects = parse_dumps(dir)
+    write_database(final_df, rejects, db_path, 'data/database.parquet', 'data/metadata.json', 'data/series', 'data/normalized', rejects_path)
+    report(len(final_df), sum(os.path.getsize(f'{dir}/{file}') for file in dump_files(dir)), time.perf_counter() - inicio)
@@ -1,14 +1,23 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import io
+import base64
 import asyncio
-import re
-import plotly.express as px
-from pathlib import Path
-from shiny import App, Inputs, Outputs, Session, render, reactive, ui
+from shiny import App, Inputs, Outputs, Session, render, reactive, req, ui
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+import plotly.graph_objects as go
 from shinywidgets import output_widget, render_widget  
-from urllib.request import Request, urlopen
-from bs4 import BeautifulSoup
+from loader import load_metadata, load_series
+from cube import RankingCube, Filtros, COLUNAS_CUBO
+from cache import LRUCache
+import graficos
+import workers
+from reatividade import debounce
+from historico import modelos_por_ano_fab
+from particoes import Particoes
+import compartilhado
+from busca import ModeloBusca, LIMITE
+from placa import PlacaService, PlacaInvalida, PlacaNaoEncontrada, ErroConsulta
+import metricas
+from inflacao import Deflator
 
 # the code is organized in this order using shiny convenctions
 # ui functions
@@ -19,16 +28,57 @@ from bs4 import BeautifulSoup
 #   - 'Ranking de Valores' functions
 #   - 'Histórico Modelo individual' functions
 
-path_to_db = Path(__file__).parent.parent.parent / "data" / "database.csv"
-df = pd.read_csv(path_to_db, sep=';')
+# bounds and distinct values used by the ui (the rows themselves are only loaded on demand)
+metadata = load_metadata()
+ultimo_ano_ref = metadata['anos_ref'][-1]
+# ano_ref partitions and model histories, read on first use and kept in a memory-bounded LRU
+# (or views over the copy of the database shared by every process, with FIPE_COMPARTILHADO, see compartilhado.py)
+particoes = compartilhado.anexa() if compartilhado.ATIVO else Particoes()
+# memory-mapped price series of every vehicle (None when data/series is missing or stale)
+series = load_series()
+# IPCA table used by the 'Corrigir pela inflação' switches (prices in reais of deflator.base)
+deflator = Deflator()
+# sum/count of 'valor' pre-aggregated by the ranking filters, one cube per ano_ref built on first use
+ranking_cubes = LRUCache(maxsize=8)         # ano_ref -> RankingCube
+# search of model names for the 'Por Veículo' dropdown (models of the latest year of reference)
+modelo_busca = ModeloBusca(modelos_por_ano_fab(particoes.ano(ultimo_ano_ref, ['ano_ref', 'ano_fab', 'modelo'])))
+# async plate lookup (placafipe.com) with a TTL cache of the parsed pages
+placa_service = PlacaService()
+
+# caches shared by all sessions, keyed by the normalized filters of the ranking
+ranking_cache = LRUCache(maxsize=256)       # Filtros -> ranking (pd.Series)
+
+# caches reported by the instrumentation (FIPE_METRICAS, see metricas.py)
+metricas.registra_cache('ranking_cache', ranking_cache)
+metricas.registra_cache('ranking_cubes', ranking_cubes)
+metricas.registra_cache('particoes', particoes.cache)
+metricas.registra_cache('png_cache', graficos.png_cache)
+metricas.registra_cache('placa_cache', placa_service.cache)
+
+def calcula_ranking(filtros):
+    """
+    Ranking of the filters (module level, so it can be sent to the worker pool)
+    """
+    cube = ranking_cubes.get_or_compute(filtros.ano_ref, lambda: RankingCube(particoes.ano(filtros.ano_ref, COLUNAS_CUBO), deflator))
+    return cube.ranking(filtros)
+
+def carrega_historico(modelo_nome, ano_fab, real=False):
+    """
+    Price history of a model (module level, so it can be sent to the worker pool)
+    real: prices adjusted by the inflation
+    """
+    if series is not None:
+        result = series.historico(modelo_nome, ano_fab)
+    else:
+        result = particoes.historico(modelo_nome, ano_fab)
+    if real:
+        result = result.assign(valor=deflator.deflaciona(result))
+    return result
 
 # dicts used for integrate the front-end with the application
 dict_combustivel = {'g': "Gasolina", 'a': "Álcool", 'd': "Diesel", 'e': "Elétrico"}
 dict_cambio = {'m': "Manual", 'a': "Automático"}
 
-# global variable used for getting the ano/modelo in the 'por placa' tab 
-ano_modelo_placa = 0
-
 # ------------------------ FUNCTIONS FOR SHOWING ------------------------
 
 def show_nothing():
@@ -37,6 +87,13 @@ def show_nothing():
     """
     return ""
 
+def show_png(png):
+    """
+    Used for showing the matplotlib plots (rendered to png bytes by graficos)
+    """
+    png = base64.b64encode(png).decode()
+    return ui.img(src=f"data:image/png;base64,{png}", style="width: 100%; height: 400px; object-fit: contain;")
+
 def show_tam_motor():
     """
     Used in the'Ranking de Valores' tab
@@ -49,9 +106,9 @@ def show_tam_motor():
                 ui.input_numeric(
                     id="tam_motor_min", 
                     label="Min (L):",
-                    min=min(df['tam_motor']),
-                    max=max(df['tam_motor']),
-                    value=min(df['tam_motor']),
+                    min=metadata['tam_motor_min'],
+                    max=metadata['tam_motor_max'],
+                    value=metadata['tam_motor_min'],
                     step=0.1,
                 ),
             ),
@@ -60,9 +117,9 @@ def show_tam_motor():
                 ui.input_numeric(
                     id="tam_motor_max", 
                     label="Max (L):",
-                    min=min(df['tam_motor']),
-                    max=max(df['tam_motor']),
-                    value=max(df['tam_motor']),
+                    min=metadata['tam_motor_min'],
+                    max=metadata['tam_motor_max'],
+                    value=metadata['tam_motor_max'],
                     step=0.1,
                 ),
             ),
@@ -92,7 +149,7 @@ def show_filtrar_marcas_on():
         ui.input_checkbox_group(
             id="marcas_selecionadas", 
             label="Selecionar Marcas", 
-            choices=df['marca'].tolist(),
+            choices=metadata['marcas'],
             selected=None,
         ),
     ]
@@ -212,16 +269,16 @@ def nav_ranking():
                 ui.input_select(
                     id="ano_ref",
                     label="Ano de referência:",
-                    choices=sorted(df['ano_ref'].unique().tolist()),
-                    selected=2023,
+                    choices=metadata['anos_ref'],
+                    selected=ultimo_ano_ref,
                 ),
                 # anofab: 	slide 19xx --- 2023
                 ui.input_slider(
                     id="ano_fab",
                     label="Ano de fabricação:",
-                    min=min(df['ano_fab']),
-                    max=2023,
-                    value=2023,
+                    min=metadata['ano_fab_min'],
+                    max=ultimo_ano_ref,
+                    value=ultimo_ano_ref,
                     sep='',
                     animate=True,
                 ),
@@ -239,6 +296,7 @@ def nav_ranking():
                     choices={'': "Mais Baratas(os)", '1': "Mais caras(os)"}, # '' to bool(str) => False
                     selected='',
                 ),
+                ui.input_switch("inflacao", "Corrigir pela inflação (IPCA)"),
                 # nav filtros avançados
                 ui.accordion(
                     ui.accordion_panel(
@@ -248,7 +306,7 @@ def nav_ranking():
                 ),   
             ),
             ui.panel_main(
-                ui.output_plot("plot_ranking", height='400px'),
+                ui.output_ui("plot_ranking"),
                 ui.input_action_button("btn_interacoes", "Mostrar/Esconder Plot com Interações"),
                 output_widget("plot_ranking_interativo"),                    
             ),
@@ -277,11 +335,12 @@ def nav_historico():
                     # locally its working fine
                     ui.nav_panel("Por Placa", nav_historico_placa()), 
                 ),
+                ui.input_switch("historico_inflacao", "Corrigir pela inflação (IPCA)"),
             ),
             ui.panel_main(
                 ui.navset_hidden(
-                    ui.nav_panel(None, ui.output_plot("plot_historico_veiculo"), value='veiculo'),
-                    ui.nav_panel(None, ui.output_plot("plot_historico_placa"), value='placa'),
+                    ui.nav_panel(None, ui.output_ui("plot_historico_veiculo"), value='veiculo'),
+                    ui.nav_panel(None, ui.output_ui("plot_historico_placa"), value='placa'),
                     id="nav_plot_veiculo_ou_placa",
                 ),
                 
@@ -297,8 +356,8 @@ def nav_historico_veiculo():
         ui.input_select(
             id="modelo_ano_fab",
             label="Ano de fabricação:",
-            choices=list(range(2023, min(df['ano_fab'])-1, -1)),
-            selected=2023,
+            choices=list(range(ultimo_ano_ref, metadata['ano_fab_min']-1, -1)),
+            selected=ultimo_ano_ref,
             multiple=False,
         ),
         ui.input_selectize(
@@ -344,46 +403,105 @@ app_ui = ui.page_fluid(
 # server settings for shiny
 def server(input: Inputs, output: Outputs, session: Session):
 
+    # ano/modelo of the last plate searched in the 'por placa' tab (per session: concurrent
+    # sessions served by the same process don't see each other's searches)
+    ano_modelo_placa = reactive.Value(None)
+
     # ------------------------ FUNCTIONS FOR 'RANKING DE VALORES' TAB  ------------------------
-    @reactive.Calc
-    def ranking_data():
+    def build_ranking_filtros(input):
         """
-        Gets the dataframe data for the 'Ranking de Valores' plots
+        Normalizes the inputs of the 'Ranking de Valores' tab into the filters of the ranking cube
         """
-        if input.switch_marcas():
-            result = df[df['marca'].str.contains('|'.join(input.marcas_selecionadas()))]
-        else:
-            result = df
-
-        # ano_ref
-        result = result[result['ano_ref'] == int(input.ano_ref())]
-        # ano_fab
-        result = result[result['ano_fab'] == int(input.ano_fab())]
-        # combustivel (filtro avancado)
-        result = result[result['combustivel'].str.contains('|'.join(input.combustivel()))]
-        # cambio (filtro avancado)
-        result = result[result['cambio'].str.contains('|'.join(input.cambio()))]
-
         # tam_motor (filtro avancado)
-        if input.choose_tam_motor() == '1':            
+        tam_motor = None
+        if input.choose_tam_motor() == '1':
+            # the numeric fields are None while they are cleared
+            req(input.tam_motor_min() is not None, input.tam_motor_max() is not None)
             tam_motor_max = float(input.tam_motor_max())
             tam_motor_min = float(input.tam_motor_min())
             if (tam_motor_max >= tam_motor_min):
-                result = result[(result['tam_motor'] <= tam_motor_max)]
-                result = result[(result['tam_motor'] >= tam_motor_min)]
-        
+                tam_motor = (tam_motor_min, tam_motor_max)
+
         # tipo_motor (filtro avancado)
+        tipo_motor = None
         if input.choose_tipo_motor() == '1':
-            result = result[result['modelo'].str.contains('|'.join(input.tipo_motor()))]
-
-        # agrupa
-        result = result.groupby(input.analise())['valor'].mean()
-        # ordem
-        result = result.sort_values(ascending=bool(input.ordem()))
-        # qntd (filtro avancado)
-        result = result.tail(int(input.qntd()))
-    
+            tipo_motor = tuple(input.tipo_motor())
+
+        marcas = None
+        if input.switch_marcas():
+            marcas = tuple(input.marcas_selecionadas())
+
+        req(input.cambio())
+        return Filtros(
+            ano_ref=int(input.ano_ref()),
+            ano_fab=int(input.ano_fab()),
+            analise=input.analise(),
+            decrescente=bool(input.ordem()),
+            qntd=int(input.qntd()),
+            combustivel=tuple(input.combustivel()),
+            cambio=tuple(input.cambio()),
+            tam_motor=tam_motor,
+            tipo_motor=tipo_motor,
+            marcas=marcas,
+            real=bool(input.inflacao()),
+        )
+
+    # the heavy work runs in the worker pool as extended tasks: the event loop keeps serving the other
+    # sessions, and a task still running for inputs that already changed (e.g. while the ano_fab slider
+    # animates) is cancelled when the next one starts
+    @reactive.extended_task
+    async def ranking_task(filtros):
+        with metricas.medir('ranking_data') as medida:
+            result = await ranking_cache.get_or_compute_async(filtros, lambda: workers.executar(calcula_ranking, filtros))
+            medida.linhas = len(result)
         return result
+
+    @debounce(0.3)
+    def ranking_inputs():
+        """
+        Filters and title of the ranking. Bursts of input changes (the animated ano_fab slider, the engine
+        size bounds updating each other...) are coalesced into one change, so the ranking and both plots
+        are computed once per burst
+        """
+        if input.btn_titulo() % 2 == 0:
+            title = build_ranking_title(input)
+        else:
+            title = ''
+        return build_ranking_filtros(input), title
+
+    # filters of the last ranking started (only a change of the filters starts a new one)
+    ranking_filtros = None
+
+    @reactive.Effect
+    def _():
+        nonlocal ranking_filtros
+        try:
+            filtros = ranking_inputs()[0]
+        except Exception:
+            # shown by the plots (see ranking_erro)
+            return
+        with reactive.isolate():
+            if filtros == ranking_filtros and ranking_task.status() != 'error':
+                return
+        ranking_filtros = filtros
+        ranking_task.cancel()
+        ranking_task(filtros)
+
+    @reactive.Calc
+    def ranking_data():
+        """
+        Gets the dataframe data for the 'Ranking de Valores' plots
+        """
+        return ranking_task.result()
+
+    @reactive.Calc
+    def ranking_erro():
+        """
+        Raises the error of the inputs or of the ranking, if any. The effects that start the tasks ignore
+        these errors (an error escaping an effect closes the session), so the plots call this to show them
+        """
+        ranking_inputs()
+        ranking_data()
     
     def build_ranking_title(input):
         """
@@ -412,7 +530,7 @@ def server(input: Inputs, output: Outputs, session: Session):
             combustiveis = ', '.join(combustiveis)
             filtros.append(f'com tipo de combustível: {combustiveis}')
 
-        if len(input.cambio()) < 2:
+        if len(input.cambio()) == 1:
             filtros.append(f'com câmbio {dict_cambio[input.cambio()[0]].lower()}')
 
         if input.choose_tam_motor() == '1':
@@ -436,69 +554,71 @@ def server(input: Inputs, output: Outputs, session: Session):
         else:
             filtros = ''
 
-        title = f'{analise} {ordenacao} fabricad{genero}s em {input.ano_fab()}{filtros}\n (ref. {input.ano_ref()})'
+        referencia = f'ref. {input.ano_ref()}'
+        if input.inflacao():
+            referencia += f', em R$ de {deflator.base} pelo IPCA'
+
+        title = f'{analise} {ordenacao} fabricad{genero}s em {input.ano_fab()}{filtros}\n ({referencia})'
         return title
 
 
-    def build_ranking_plot_matplotlib():
-        """
-        Build the plot the data for the 'Ranking de Valores' tab using matplotlib
-        """
-        result = ranking_data()
-
-        plt.style.use('dark_background')
-        plt.rcParams.update({
-            'axes.facecolor': '#1e1e1e',
-            'axes.edgecolor': '#f4f4f4',
-            'axes.labelcolor': '#f4f4f4',
-            'xtick.color': '#f4f4f4',
-            'ytick.color': '#f4f4f4',
-            'grid.color': '#494949',
-            'text.color': '#f4f4f4',
-            'figure.facecolor': '#1e1e1e',
-            'figure.edgecolor': '#1e1e1e',
-            'savefig.facecolor': '#1e1e1e',
-            'savefig.edgecolor': '#1e1e1e'
-        })
+    @reactive.extended_task
+    async def ranking_interativo_task(result):
+        with metricas.medir('ranking_interativo'):
+            return await workers.executar(graficos.ranking_interativo, result)
+
+    @reactive.Effect
+    def _():
+        if int(input.btn_interacoes()) % 2 == 1:
+            try:
+                result = ranking_data()
+            except Exception:
+                return
+            ranking_interativo_task.cancel()
+            ranking_interativo_task(result)
 
-        if input.btn_titulo() % 2 == 0:
-            title = build_ranking_title(input)
-        else:
-            title = ''
-            
-        plt.title(title)        
-        plt.barh(result.index, result.values, color='#e64729') 
-        plt.xlabel('valor')
-        plt.ylabel(input.analise())
-        plt.gca().xaxis.grid(True, color='#494949') 
-        
-        return plt
-    
     @render_widget
     def plot_ranking_interativo():
         """
         Generate interactive plot of the data for the 'Ranking de Valores' tab using plotly
         """
         if int(input.btn_interacoes()) % 2 == 1:
+            ranking_erro()
+            fig = ranking_interativo_task.result()
+            # converted to the widget here (the same conversion render_widget does), so it is measured
+            with metricas.medir('plot_ranking_interativo'):
+                return go.FigureWidget(fig.data, fig.layout)
+
+    @reactive.extended_task
+    async def ranking_png_task(result, title, analise):
+        with metricas.medir('ranking_png'):
+            return await graficos.ranking_png(result, title, analise)
+
+    @reactive.Effect
+    def _():
+        try:
             result = ranking_data()
-            fig = px.bar(result, y=result.index, x=result.values, orientation='h',
-                        title="Plot Interativo",
-                        color_discrete_sequence=['#e64729'])
-            fig.update_layout(
-                plot_bgcolor='#1e1e1e',
-                paper_bgcolor='#1e1e1e',
-                font_color='#f4f4f4'
-            )
-            return fig
-    
+            filtros, title = ranking_inputs()
+        except Exception:
+            return
+        ranking_png_task.cancel()
+        ranking_png_task(result, title, filtros.analise)
+
+    @reactive.Calc
+    def ranking_png():
+        """
+        Png of the 'Ranking de Valores' plot, rendered once per plotted data in the whole process
+        """
+        return ranking_png_task.result()
+
     @output
-    @render.plot
+    @render.ui
     def plot_ranking():
         """
         Plots the data for the 'Ranking de Valores' tab using matplotlib
         """
-        plt = build_ranking_plot_matplotlib()
-        return plt.gcf()
+        ranking_erro()
+        return show_png(ranking_png())
 
     @render.download(filename="ranking.png")
     async def download_ranking_plot():
@@ -506,11 +626,7 @@ def server(input: Inputs, output: Outputs, session: Session):
         When 'Download Plot' button is pressed in the'Ranking de Valores' tab this function downloads the plot
         """      
         await asyncio.sleep(0.25)   
-        plt = build_ranking_plot_matplotlib()
-
-        with io.BytesIO() as buf:
-            plt.savefig(buf, format="png")
-            yield buf.getvalue()
+        yield ranking_png()
 
     # ------------------------ REACTIVE FUNCTIONS FOR INTERFACE VALUES  ------------------------
 
@@ -553,76 +669,81 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     # ------------------------ FUNCTIONS FOR 'HISTÓRICO MODELO INDIVIDUAL' TAB  ------------------------
     
-    def build_historico_plot(por_modalidade):
+    def build_historico_args(por_modalidade):
         """
-        Build the plot the data for the 'Histórico Modelo Individual' tab using matplotlib
+        Model, year and inflation adjustment of the plot for the 'Histórico Modelo Individual' tab
         """
-        plt.style.use('dark_background')
-        plt.rcParams.update({
-            'axes.facecolor': '#1e1e1e',
-            'axes.edgecolor': '#f4f4f4',
-            'axes.labelcolor': '#f4f4f4',
-            'xtick.color': '#f4f4f4',
-            'ytick.color': '#f4f4f4',
-            'grid.color': '#494949',
-            'text.color': '#f4f4f4',
-            'figure.facecolor': '#1e1e1e',
-            'figure.edgecolor': '#1e1e1e',
-            'savefig.facecolor': '#1e1e1e',
-            'savefig.edgecolor': '#1e1e1e'
-        })
-
-        global ano_modelo_placa
         if por_modalidade == 'veiculo':
-            modelo_nome = df.iloc[int(input.modelo_index())]["modelo"]
+            req(input.modelo_index())
+            modelo_nome = input.modelo_index()
             ano_fab = int(input.modelo_ano_fab())
         else: # por_modalidade == 'placa'
+            req(ano_modelo_placa())
             modelo_nome = input.modelo_placa_selecionado()
-            ano_fab = ano_modelo_placa
-        
-        result = df[df["modelo"] == modelo_nome]
-        result = result[result["ano_fab"] == ano_fab]
-        plt.title(modelo_nome)
-        plt.barh(result["ano_ref"], result["valor"], color='#e64729')
-        plt.xlabel('valor')
-        plt.ylabel('ano ref.')
+            ano_fab = ano_modelo_placa()
+        return modelo_nome, ano_fab, bool(input.historico_inflacao())
 
-    
-        plt.yticks(range(int(min(result["ano_ref"])), int(max(result["ano_ref"]))+1))
-        plt.gca().xaxis.grid(True, color='#494949')
+    async def build_historico_png(modelo_nome, ano_fab, real):
+        """
+        Png of the plot for the 'Histórico Modelo Individual' tab using matplotlib
+        """
+        with metricas.medir('historico_dados') as medida:
+            result = await workers.executar(carrega_historico, modelo_nome, ano_fab, real)
+            medida.linhas = len(result)
+        title = f'{modelo_nome} (R$ de {deflator.base}, IPCA)' if real else modelo_nome
+        with metricas.medir('historico_png'):
+            return await graficos.historico_png(result, title)
 
-        return plt
+    @reactive.extended_task
+    async def historico_veiculo_task(modelo_nome, ano_fab, real):
+        return await build_historico_png(modelo_nome, ano_fab, real)
 
-    @output
-    @render.plot
+    @reactive.extended_task
+    async def historico_placa_task(modelo_nome, ano_fab, real):
+        return await build_historico_png(modelo_nome, ano_fab, real)
+
+    @reactive.Effect
     @reactive.event(input.btn_veiculo_exibir, ignore_none=True)
+    def _():
+        args = build_historico_args('veiculo')
+        historico_veiculo_task.cancel()
+        historico_veiculo_task(*args)
+
+    @reactive.Effect
+    @reactive.event(input.btn_placa_exibir, ignore_none=True)
+    def _():
+        args = build_historico_args('placa')
+        historico_placa_task.cancel()
+        historico_placa_task(*args)
+
+    @output
+    @render.ui
     def plot_historico_veiculo():
         """
         Plots the data for the 'Por Veículo' tab using matplotlib
         """
-        plt = build_historico_plot('veiculo')
+        return show_png(historico_veiculo_task.result())
 
     @output
-    @render.plot
-    @reactive.event(input.btn_placa_exibir, ignore_none=True)
+    @render.ui
     def plot_historico_placa():
         """
         Plots the data for the 'Por Placa' tab using matplotlib
         """
-        plt = build_historico_plot('placa')
+        return show_png(historico_placa_task.result())
 
     @render.download(filename="historico.png")
     async def download_historico_plot():
         """
         When 'Download Plot' button is pressed in the'Histórico Modelo Individual' tab this function downloads the plot
-        """         
-        await asyncio.sleep(0.25)   
-        plt = build_historico_plot()
+        (the one being shown: 'Por Veículo' or 'Por Placa')
+        """
+        await asyncio.sleep(0.25)
+        if input.nav_plot_veiculo_ou_placa() == 'placa':
+            yield historico_placa_task.result()
+        else:
+            yield historico_veiculo_task.result()
 
-        with io.BytesIO() as buf:
-            plt.savefig(buf, format="png")
-            yield buf.getvalue()
-    
     # ------------------------ REACTIVE FUNCTIONS FOR INTERFACE VALUES  ------------------------
 
     @reactive.Effect
@@ -638,57 +759,38 @@ def server(input: Inputs, output: Outputs, session: Session):
     @reactive.Effect
     @reactive.event(input.modelo_ano_fab)
     def _():
-        modelo_ano_fab = int(input.modelo_ano_fab())
-        modelos = df[df["ano_ref"] == 2023]
-        modelos = modelos[modelos["ano_fab"] == modelo_ano_fab]
-        ui.update_selectize("modelo_index", choices=modelos["modelo"])
+        """
+        The options of the 'Por Veículo' dropdown are searched in the server as the user types,
+        only the best matches (made in the chosen year) are sent to the browser
+        """
+        ano_fab = int(input.modelo_ano_fab())
+
+        def buscar_modelos(request):
+            consulta = request.query_params.get("query", "")
+            try:
+                limite = min(max(int(request.query_params.get("maxop", LIMITE)), 1), LIMITE)
+            except ValueError:
+                limite = LIMITE
+            with metricas.medir('busca_modelos') as medida:
+                modelos = modelo_busca.buscar(consulta, ano_fab, limite)
+                medida.linhas = len(modelos)
+            # selectize escapes the labels itself
+            return JSONResponse([{"value": modelo, "label": modelo} for modelo in modelos])
+
+        url = session.dynamic_route("busca_modelo_index", buscar_modelos)
+        session.send_input_message("modelo_index", {"value": "", "url": url})
 
     @reactive.Effect
     @reactive.event(input.btn_buscar_placa)
-    def _():
+    async def _():
         """
         Web scrapping used for searching the plate inside 'Por Placa' tab
+        (async: the other sessions are not blocked while the site answers)
         """
-        global ano_modelo_placa
-        padrao = r"[a-zA-Z]{3}\d([a-zA-Z]|\d)\d{2}"
-        if re.fullmatch(padrao, input.modelo_placa()):
-            url = f'https://placafipe.com/placa/{input.modelo_placa()}'
-            req = Request(
-                url=url, 
-                headers={'User-Agent': 'Mozilla/5.0'}
-            )
-            response = urlopen(req)
-            status_code = response.getcode()
-
-            if status_code == 200:
-                soup = BeautifulSoup(response, 'html.parser')
-                aviso_placa_nao_encontrada = soup.select_one('.template-middle > div:nth-child(1) > p:nth-child(2)')
-                if aviso_placa_nao_encontrada == None:
-                    modelos_por_placa = []
-                    tabela = soup.select_one('.fipe-desktop')
-                    for linha in tabela.find_all('tr')[1:]:
-                        modelos_por_placa.append(linha.find_all('td')[1].text)
-                    ano_modelo_placa = int(soup.select_one('.fipeTablePriceDetail').find_all('tr')[5].find_all('td')[1].text)
-                    ui.update_navs("nav_modelos_placa", selected='1')
-                    ui.update_selectize("modelo_placa_selecionado", choices=modelos_por_placa)
-                else:
-                    m = ui.modal(
-                        aviso_placa_nao_encontrada.text,
-                        title="Placa Incorreta",
-                        easy_close=True,
-                        footer=None,
-                    )
-                    ui.modal_show(m)
-                    ui.update_navs("nav_modelos_placa", selected='0')
-            else:
-                m = ui.modal(
-                    "Recarregue e tente novamente! Se o erro persistir contate o desenvolvedor",
-                    title="Erro ao abrir o site",
-                    easy_close=True,
-                    footer=None,
-                )
-                ui.modal_show(m)
-        else:
+        try:
+            with metricas.medir('placa'):
+                placa = await placa_service.buscar(input.modelo_placa())
+        except PlacaInvalida:
             m = ui.modal(
                 "Digite a placa no formato ABC1234 ou ABC1D23",
                 title="Padrão incorreto da placa",
@@ -697,6 +799,33 @@ def server(input: Inputs, output: Outputs, session: Session):
             )
             ui.modal_show(m)
             ui.update_navs("nav_modelos_placa", selected='0')
+        except PlacaNaoEncontrada as aviso:
+            m = ui.modal(
+                str(aviso),
+                title="Placa Incorreta",
+                easy_close=True,
+                footer=None,
+            )
+            ui.modal_show(m)
+            ui.update_navs("nav_modelos_placa", selected='0')
+        except ErroConsulta:
+            m = ui.modal(
+                "Recarregue e tente novamente! Se o erro persistir contate o desenvolvedor",
+                title="Erro ao abrir o site",
+                easy_close=True,
+                footer=None,
+            )
+            ui.modal_show(m)
+        else:
+            ano_modelo_placa.set(placa.ano_modelo)
+            ui.update_navs("nav_modelos_placa", selected='1')
+            ui.update_selectize("modelo_placa_selecionado", choices=placa.modelos)
 
 
 app = App(app_ui, server)
+
+if metricas.ATIVO:
+    # GET /metricas answers the json of the instrumentation (added in front of the routes of shiny)
+    app.starlette_app.router.routes.insert(0, Route('/metricas', metricas.endpoint))
+    if metricas.INTERVALO_LOG > 0:
+        metricas.inicia_log()
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+# reads the binary files written by src/create_binaries.c, without parsing the csv again
+#   - bin/sequencial.bin: fixed-size Carro records (src/structs/entities.h), memory-mapped as a numpy structured array
+#   - bin/index.btree: B-tree (src/structs/btree.c) of the Carro records, for point lookups by key
+#   - bin/brands.trie and bin/<cod_marca>.trie: names of the brands and models, the code is the line number
+
+path_to_bin = Path(__file__).parent.parent.parent / "bin"
+
+# struct Carro (entities.h): int, float and enum fields, 4 bytes each, no padding
+CARRO = np.dtype([
+    ('cod', '<i4'),
+    ('ano_ref', '<i4'),
+    ('mes_ref', '<i4'),         # Mes: JAN = 1 ... DEZ = 12
+    ('cod_marca', '<i4'),
+    ('cod_modelo', '<i4'),
+    ('ano_fab', '<i4'),
+    ('valor', '<f4'),
+    ('combustivel', '<i4'),     # Combustivel: GASOLINA = 1, ALCOOL, DIESEL, ELETRICO
+    ('cod_fipe', '<i4'),
+    ('cambio', '<i4'),          # Cambio: AUTOMATICO = 1, MANUAL
+    ('tam_motor', '<f4'),
+])
+
+# enums of entities.h decoded to the values used by the app (index = enum value)
+# (Mes is already the month number used in data/database.csv)
+COMBUSTIVEIS = [None, 'g', 'a', 'd', 'e']
+CAMBIOS = [None, 'a', 'm']
+
+
+def load_sequencial(path=path_to_bin / "sequencial.bin"):
+    """
+    Memory-maps sequencial.bin (read-only, nothing is copied until a column is used)
+    """
+    return np.memmap(path, dtype=CARRO, mode='r')
+
+
+def read_trie(path):
+    """
+    Returns the words of a .trie file, the word of code c is at position c - 1
+    """
+    with open(path, encoding='utf-8') as file:
+        return [linha.rstrip('\n') for linha in file]
+
+
+def decode_enum(valores, categorias):
+    """
+    Enum values -> categorical (unknown values, like the 0 of a missing field, become NaN)
+    """
+    codigos = np.asarray(valores, dtype='int64') - 1
+    codigos[(codigos < 0) | (codigos >= len(categorias) - 1)] = -1
+    return pd.Categorical.from_codes(codigos, categories=categorias[1:])
+
+
+def sequencial_to_df(carros, path=path_to_bin):
+    """
+    Decodes the Carro records into the columns of data/database.csv
+    (brand and model names come from the .trie files, enums become the app's char codes)
+    """
+    marcas = read_trie(path / "brands.trie")
+
+    # model codes are per brand: (cod_marca, cod_modelo) -> one code for the whole database
+    modelos = []
+    inicio_marca = np.zeros(len(marcas) + 1, dtype='int64')
+    for cod_marca in range(1, len(marcas) + 1):
+        inicio_marca[cod_marca] = len(modelos)
+        arquivo = path / f"{cod_marca}.trie"
+        if arquivo.exists():
+            modelos.extend(read_trie(arquivo))
+    cod_marca = np.asarray(carros['cod_marca'], dtype='int64')
+    codigos_modelo = inicio_marca[cod_marca] + np.asarray(carros['cod_modelo'], dtype='int64') - 1
+
+    # the same model name can exist in more than one brand
+    nomes_modelo, codigos_nome = np.unique(np.asarray(modelos, dtype=object), return_inverse=True)
+
+    tam_motor = np.asarray(carros['tam_motor'])
+    return pd.DataFrame({
+        'ano_ref': np.asarray(carros['ano_ref']),
+        'mes_ref': np.asarray(carros['mes_ref']),
+        'marca': pd.Categorical.from_codes(cod_marca - 1, categories=marcas),
+        'modelo': pd.Categorical.from_codes(codigos_nome[codigos_modelo], categories=nomes_modelo),
+        'ano_fab': np.asarray(carros['ano_fab']),
+        'valor': np.asarray(carros['valor']),
+        'combustivel': decode_enum(carros['combustivel'], COMBUSTIVEIS),
+        'codigo_fipe': np.asarray(carros['cod_fipe']),
+        'cambio': decode_enum(carros['cambio'], CAMBIOS),
+        # create_binaries.c writes 0 for models without engine size
+        'tam_motor': np.where(tam_motor == 0, np.float32('nan'), tam_motor),
+    })
+
+
+class BTreeIndex:
+    """
+    Read-only view of bin/index.btree (see the file structure in src/structs/btree.c)
+    """
+
+    def __init__(self, path=path_to_bin / "index.btree"):
+        cabecalho = np.fromfile(path, dtype=[('t', '<u4'), ('raiz', '<u8')], count=1)[0]
+        self.t = int(cabecalho['t'])
+        self.raiz = int(cabecalho['raiz'])
+        # nodes are written field by field (packed): leaf, n, ptr, d[2t-1], c[2t]
+        no = np.dtype([
+            ('leaf', 'u1'),
+            ('n', '<u8'),
+            ('ptr', '<u8'),
+            ('keys', [('key', '<u8'), ('value', '<u8')], (2 * self.t - 1,)),
+            ('c', '<u8', (2 * self.t,)),
+        ])
+        self.nos = np.memmap(path, dtype=no, mode='r', offset=cabecalho.nbytes)
+
+    @staticmethod
+    def chave(ano_ref, mes_ref, cod_marca, cod_modelo=0, ano_fab=0):
+        """
+        Key of a Carro as built by create_binaries.c (and by the search command of the search app)
+        """
+        chave = ano_ref % 100
+        chave = (chave << 8) + mes_ref
+        chave = (chave << 8) + cod_marca
+        chave = (chave << 12) + cod_modelo
+        chave = (chave << 16) + ano_fab
+        return chave
+
+    def search(self, chave):
+        """
+        Returns the value (the cod of the Carro, i.e. its position in sequencial.bin) of chave, or None
+        """
+        ptr = self.raiz
+        while ptr != 0:
+            no = self.nos[ptr - 1]
+            n = int(no['n'])
+            chaves = no['keys']['key'][:n]
+            i = int(np.searchsorted(chaves, chave, side='left'))
+            if i < n and chaves[i] == chave:
+                return int(no['keys']['value'][i])
+            if no['leaf']:
+                return None
+            ptr = int(no['c'][i])
+        return None
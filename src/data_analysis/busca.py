@@ -0,0 +1,101 @@
+import bisect
+import numpy as np
+
+# server-side search of model names for the 'Por Veículo' dropdown
+# plays the role of src/structs/trie.c in the python app, but over sorted arrays
+# (a node per character would cost far more memory in python):
+#   - sorted names, for prefix search with binary search (same results and order of a trie walk)
+#   - sorted (word, name) pairs, for names with a word starting with the query
+#   - plain substring match as the last resort
+# only the top matches are returned, so the browser never receives the whole model list
+
+# default number of options sent to the browser per search
+LIMITE = 50
+
+
+class ModeloBusca:
+
+    def __init__(self, modelos_por_ano_fab):
+        """
+        modelos_por_ano_fab: ano_fab -> names of the models (e.g. historico.modelos_por_ano_fab)
+        """
+        nomes = set()
+        for modelos in modelos_por_ano_fab.values():
+            nomes.update(modelos)
+        ordenados = sorted(nomes, key=normaliza)
+        self.nomes = ordenados
+        self.chaves = [normaliza(nome) for nome in ordenados]
+
+        palavras = []
+        for indice, chave in enumerate(self.chaves):
+            for palavra in set(chave.split()):
+                palavras.append((palavra, indice))
+        palavras.sort()
+        self.palavras = [palavra for palavra, _ in palavras]
+        self.palavras_indices = [indice for _, indice in palavras]
+
+        # ano_fab -> which names (by position in self.nomes) exist in that year
+        posicao = {nome: indice for indice, nome in enumerate(ordenados)}
+        self.mascaras = {}
+        for ano, modelos in modelos_por_ano_fab.items():
+            mascara = np.zeros(len(ordenados), dtype=bool)
+            mascara[[posicao[nome] for nome in modelos]] = True
+            self.mascaras[int(ano)] = mascara
+
+    def buscar(self, consulta, ano_fab, limite=LIMITE):
+        """
+        Returns up to limite model names made in ano_fab matching consulta (case insensitive):
+        names starting with consulta first, then names with words starting with every term, then
+        names containing every term
+        """
+        mascara = self.mascaras.get(int(ano_fab))
+        if mascara is None:
+            return []
+        consulta = normaliza(consulta)
+        termos = consulta.split()
+
+        encontrados = []
+        vistos = set()
+
+        def adiciona(indice):
+            if mascara[indice] and indice not in vistos:
+                vistos.add(indice)
+                encontrados.append(indice)
+            return len(encontrados) >= limite
+
+        # names starting with the query (a contiguous range of the sorted names)
+        inicio = bisect.bisect_left(self.chaves, consulta)
+        for indice in range(inicio, len(self.chaves)):
+            if not self.chaves[indice].startswith(consulta):
+                break
+            if adiciona(indice):
+                return self.resultado(encontrados)
+        if not termos:
+            return self.resultado(encontrados)
+
+        # names with a word starting with the first term, checked for the remaining terms
+        candidatos = []
+        inicio = bisect.bisect_left(self.palavras, termos[0])
+        for posicao in range(inicio, len(self.palavras)):
+            if not self.palavras[posicao].startswith(termos[0]):
+                break
+            candidatos.append(self.palavras_indices[posicao])
+        for indice in sorted(set(candidatos)):
+            palavras = self.chaves[indice].split()
+            if all(any(palavra.startswith(termo) for palavra in palavras) for termo in termos[1:]):
+                if adiciona(indice):
+                    return self.resultado(encontrados)
+
+        # names containing every term anywhere (e.g. in the middle of a word)
+        for indice in np.flatnonzero(mascara):
+            if all(termo in self.chaves[indice] for termo in termos):
+                if adiciona(indice):
+                    break
+        return self.resultado(encontrados)
+
+    def resultado(self, indices):
+        return [self.nomes[indice] for indice in indices]
+
+
+def normaliza(nome):
+    return ' '.join(str(nome).lower().split())
@@ -0,0 +1,101 @@
+import time
+import threading
+from collections import OrderedDict
+
+# process-wide caches shared by every session of the app
+# e.g. most users open the default ranking (ano_ref=2023, ano_fab=2023, marcas), which is
+# computed and rendered only once per process
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts the least recently used entry when full
+    (and, if ttl is given, entries older than ttl seconds)
+    If maxbytes is given, entries are also evicted while the sum of tamanho(valor) is above it
+    Safe to share between sessions (and threads); keeps hit/miss counters
+    """
+
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None, tamanho=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.tamanho = tamanho
+        self.dados = OrderedDict()
+        self.validade = {}
+        self.tamanhos = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chave, default=None):
+        with self.lock:
+            if chave in self.dados and self.ttl is not None and self.validade[chave] < time.monotonic():
+                self.remove(chave)
+            if chave in self.dados:
+                self.dados.move_to_end(chave)
+                self.hits += 1
+                return self.dados[chave]
+            self.misses += 1
+            return default
+
+    def put(self, chave, valor):
+        with self.lock:
+            if chave in self.dados:
+                self.remove(chave)
+            self.dados[chave] = valor
+            if self.ttl is not None:
+                self.validade[chave] = time.monotonic() + self.ttl
+            if self.maxbytes is not None:
+                self.tamanhos[chave] = self.tamanho(valor)
+                self.bytes += self.tamanhos[chave]
+            # the entry just added is kept even if it alone is above maxbytes
+            while len(self.dados) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes and len(self.dados) > 1):
+                self.remove(next(iter(self.dados)))
+
+    def remove(self, chave):
+        # caller holds the lock
+        del self.dados[chave]
+        self.validade.pop(chave, None)
+        self.bytes -= self.tamanhos.pop(chave, 0)
+
+    def get_or_compute(self, chave, calcula):
+        """
+        Returns the cached value of chave, calling calcula() (outside the lock) on a miss
+        """
+        sentinela = object()
+        valor = self.get(chave, sentinela)
+        if valor is sentinela:
+            valor = calcula()
+            self.put(chave, valor)
+        return valor
+
+    async def get_or_compute_async(self, chave, calcula):
+        """
+        Same as get_or_compute, for a calcula() that returns an awaitable (e.g. work sent to the worker pool)
+        """
+        sentinela = object()
+        valor = self.get(chave, sentinela)
+        if valor is sentinela:
+            valor = await calcula()
+            self.put(chave, valor)
+        return valor
+
+    def clear(self):
+        with self.lock:
+            self.dados.clear()
+            self.validade.clear()
+            self.tamanhos.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            stats = {'size': len(self.dados), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+            if self.maxbytes is not None:
+                stats.update(bytes=self.bytes, maxbytes=self.maxbytes)
+            return stats
+
+    def __len__(self):
+        return len(self.dados)
@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import fcntl
+import shutil
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import loader
+from cache import LRUCache
+from particoes import tamanho_frame
+
+# shared read-only copy of the database, for serving the app with several processes
+# the database is materialized once (sorted by ano_ref) as a .npy file per column (categoricals as their codes, with the
+# categories in dataset.json) and every app process memory-maps the columns: the frames handed to the ranking and
+# history views are built over the mapped pages without copying them, so N workers share a single copy of the data
+# and only the first one pays for the load
+#   FIPE_COMPARTILHADO=<dir> enables it (a directory in /dev/shm keeps the columns in shared memory)
+# the first process to start materializes it (under a file lock, the others wait and attach), or it can be done beforehand:
+#
+#   $ python src/data_analysis/compartilhado.py /dev/shm/fipe
+#   $ FIPE_COMPARTILHADO=/dev/shm/fipe shiny run --port 8001    # one per process, behind a proxy with sticky sessions
+# (not `--workers`: the model search and the downloads are http routes of a session, served by the process that created it)
+
+DIRETORIO = os.environ.get('FIPE_COMPARTILHADO')
+ATIVO = bool(DIRETORIO)
+
+# columns used by the app (the histories also need mes_ref)
+COLUNAS = loader.COLUNAS_APP + ['mes_ref']
+
+
+def atualizado(path):
+    """
+    Whether the copy in path exists and was made from the current database
+    """
+    info = path / "dataset.json"
+    if not info.exists():
+        return False
+    with open(info, encoding='utf-8') as file:
+        fonte = json.load(file)['fonte']
+    origem = loader.database_source()
+    return fonte == {'path': str(origem), 'mtime': origem.stat().st_mtime}
+
+
+def materializa(path):
+    """
+    Writes the columns of the database into path (replacing an old copy: processes still attached to it keep
+    their mapped pages until they exit)
+    """
+    path = Path(path)
+    origem = loader.database_source()
+    mtime = origem.stat().st_mtime
+    df = loader.load_database(COLUNAS, verbose=True).sort_values('ano_ref', kind='stable', ignore_index=True)
+
+    temporario = path.with_name(f'{path.name}.tmp-{os.getpid()}')
+    os.makedirs(temporario)
+    colunas = {}
+    for coluna in COLUNAS:
+        serie = df[coluna]
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            np.save(temporario / f"{coluna}.npy", serie.cat.codes.to_numpy())
+            colunas[coluna] = [str(categoria) for categoria in serie.cat.categories]
+        else:
+            np.save(temporario / f"{coluna}.npy", serie.to_numpy())
+            colunas[coluna] = None
+
+    # rows of each year of reference: [inicio, fim)
+    anos = df['ano_ref'].to_numpy()
+    anos_ref = {int(ano): [int(np.searchsorted(anos, ano, 'left')), int(np.searchsorted(anos, ano, 'right'))] for ano in np.unique(anos)}
+    with open(temporario / "dataset.json", 'w', encoding='utf-8') as file:
+        json.dump({
+            'fonte': {'path': str(origem), 'mtime': mtime},
+            'linhas': len(df),
+            'colunas': colunas,
+            'anos_ref': anos_ref,
+        }, file, ensure_ascii=False)
+
+    antigo = path.with_name(f'{path.name}.old-{os.getpid()}')
+    if path.exists():
+        os.rename(path, antigo)
+    os.rename(temporario, path)
+    shutil.rmtree(antigo, ignore_errors=True)
+    return len(df)
+
+
+def anexa(path=None):
+    """
+    Returns the shared copy of the database in path (FIPE_COMPARTILHADO by default), materializing it first
+    when it is missing or older than the database
+    """
+    path = Path(path or DIRETORIO)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(f'{path.name}.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not atualizado(path):
+            materializa(path)
+        # mapped while the lock is held, so the copy can't be replaced in between
+        return DatasetCompartilhado(path)
+
+
+class DatasetCompartilhado:
+    """
+    Same interface as Particoes, over the memory-mapped columns
+    """
+
+    def __init__(self, path, maxbytes=64 * 2**20):
+        with open(path / "dataset.json", encoding='utf-8') as file:
+            info = json.load(file)
+        self.linhas = info['linhas']
+        self.anos_ref = {int(ano): tuple(limites) for ano, limites in info['anos_ref'].items()}
+        # mapped arrays (codes of the categoricals)
+        self.mapas = {}
+        self.colunas = {}
+        for coluna, categorias in info['colunas'].items():
+            self.mapas[coluna] = np.load(path / f"{coluna}.npy", mmap_mode='r')
+            if categorias is None:
+                self.colunas[coluna] = self.mapas[coluna]
+            else:
+                # the codes are already valid and of the dtype of the categories: they are used as they are, without a copy
+                dtype = pd.CategoricalDtype(pd.Index(categorias))
+                self.colunas[coluna] = pd.Categorical.from_codes(self.mapas[coluna], dtype=dtype, validate=False)
+        if not self.compartilha(self.frame(self.colunas, 0, self.linhas)):
+            print(f'warning: pandas {pd.__version__} copied the columns of {path}, they are not shared between the processes')
+        # histories are small copies (a mask over every row), so they are kept like in Particoes
+        self.cache = LRUCache(maxsize=256, maxbytes=maxbytes, tamanho=tamanho_frame)
+
+    def compartilha(self, df):
+        """
+        Whether every column of df is backed by the mapped files (and not by a private copy)
+        """
+        for coluna in df.columns:
+            valores = df[coluna].array
+            valores = valores.codes if isinstance(valores, pd.Categorical) else df[coluna].to_numpy()
+            if not np.shares_memory(valores, self.mapas[coluna]):
+                return False
+        return True
+
+    def frame(self, colunas, inicio, fim):
+        # slices of the mapped arrays are views, and copy=False keeps pandas from consolidating them
+        return pd.DataFrame({coluna: self.colunas[coluna][inicio:fim] for coluna in colunas}, copy=False)
+
+    def ano(self, ano_ref, colunas=loader.COLUNAS_APP):
+        """
+        Returns the rows of a year of reference, with only the columns in colunas (without copying them)
+        """
+        inicio, fim = self.anos_ref.get(int(ano_ref), (0, 0))
+        return self.frame(colunas, inicio, fim)
+
+    def historico(self, modelo, ano_fab):
+        """
+        Returns the price history (ano_ref, mes_ref, valor) of a model made in ano_fab, every price of the model name
+        sorted by ano_ref, mes_ref and valor
+        """
+        ano_fab = int(ano_fab)
+
+        def carrega():
+            modelos = self.colunas['modelo']
+            if modelo not in modelos.categories:
+                linhas = np.array([], dtype='int64')
+            else:
+                codigo = modelos.categories.get_loc(modelo)
+                linhas = np.flatnonzero((modelos.codes == codigo) & (self.colunas['ano_fab'] == ano_fab))
+            df = pd.DataFrame({coluna: self.colunas[coluna][linhas] for coluna in ['ano_ref', 'mes_ref', 'valor']})
+            return df.sort_values(['ano_ref', 'mes_ref', 'valor'], ignore_index=True)
+
+        return self.cache.get_or_compute(('historico', modelo, ano_fab), carrega)
+
+
+if __name__ == '__main__':
+    destino = Path(sys.argv[1] if len(sys.argv) > 1 else DIRETORIO or '/dev/shm/fipe')
+    dataset = anexa(destino)
+    tamanho = sum(os.path.getsize(destino / f"{coluna}.npy") for coluna in dataset.colunas)
+    print(f'{dataset.linhas} rows in {destino} ({tamanho / 2**20:.1f} MiB)')
+    # the frames handed to the app must be views over the files
+    anos = sorted(dataset.anos_ref)
+    assert dataset.compartilha(dataset.ano(anos[-1], COLUNAS)), 'the frames of the shared database are copies'
+    print(f'frames of every column are views over {destino}')
@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+from typing import NamedTuple, Optional
+
+# pre-aggregated cube used by the 'Ranking de Valores' tab
+# holds the sum and the count of 'valor' for every combination of the dimensions below, sorted by
+# (ano_ref, ano_fab), so a ranking only touches the rows of the chosen years instead of the whole database.
+# tam_motor is kept at its own resolution (0.1 L) as the engine-size bin, so any interval filter stays exact.
+# a second, coarser level without 'modelo' answers the brand rankings that don't filter by model name
+# with a deflator (inflacao.py) the cube also holds the sum of the inflation adjusted prices, so the real
+# rankings cost the same as the nominal ones
+
+
+# dimensions of the cube
+DIMENSOES = ['ano_ref', 'ano_fab', 'combustivel', 'cambio', 'marca', 'modelo', 'tam_motor']
+DIMENSOES_MARCA = [dimensao for dimensao in DIMENSOES if dimensao != 'modelo']
+# columns of the database read by the cube (mes_ref only for the inflation adjustment)
+COLUNAS_CUBO = DIMENSOES + ['mes_ref', 'valor']
+
+
+class Filtros(NamedTuple):
+    """
+    Normalized filters of a ranking (hashable, so it can also be used as a cache key)
+    None in the optional filters means that the filter is disabled
+    """
+    ano_ref: int
+    ano_fab: int
+    analise: str                            # 'marca' or 'modelo'
+    decrescente: bool                       # True: most expensive first
+    qntd: int
+    combustivel: tuple
+    cambio: tuple
+    tam_motor: Optional[tuple] = None       # (min, max)
+    tipo_motor: Optional[tuple] = None      # e.g. ('V8', 'V6')
+    marcas: Optional[tuple] = None
+    real: bool = False                      # True: prices adjusted by the inflation
+
+
+class RankingCube:
+
+    def __init__(self, df, deflator=None):
+        valores = pd.DataFrame({'valor': df['valor'].astype('float64')})
+        agregacoes = {'soma': ('valor', 'sum'), 'qntd': ('valor', 'count')}
+        if deflator is not None:
+            # periods outside of the deflator table are nan, so they have their own count
+            valores['valor_real'] = deflator.deflaciona(df)
+            agregacoes.update(soma_real=('valor_real', 'sum'), qntd_real=('valor_real', 'count'))
+        medidas = list(agregacoes)
+        agregado = valores.groupby([df[dimensao] for dimensao in DIMENSOES], observed=True, dropna=False, sort=True)
+        cube = agregado.agg(**agregacoes).reset_index()
+        cube_marca = cube.groupby(DIMENSOES_MARCA, observed=True, dropna=False, sort=True)[medidas].sum().reset_index()
+
+        # the cubes are kept as numpy columns: categorical dimensions as category codes
+        self.categorias = {}
+        self.colunas = {}
+        for nivel, cube in [('modelo', cube), ('marca', cube_marca)]:
+            colunas = {}
+            for coluna in cube.columns:
+                if isinstance(cube[coluna].dtype, pd.CategoricalDtype):
+                    self.categorias[coluna] = cube[coluna].cat.categories
+                    colunas[coluna] = cube[coluna].cat.codes.to_numpy()
+                else:
+                    colunas[coluna] = cube[coluna].to_numpy()
+            for medida in medidas:
+                colunas[medida] = colunas[medida].astype('float64')
+            self.colunas[nivel] = colunas
+
+        # (ano_ref, ano_fab) as a single sorted key for slicing each cube
+        self.chaves = {
+            nivel: self.chave(colunas['ano_ref'], colunas['ano_fab'])
+            for nivel, colunas in self.colunas.items()
+        }
+        # marca -> sorted row positions in each cube, used by the 'Filtrar Marcas' filter
+        self.posicoes_marca = {
+            nivel: indice(colunas['marca'], self.categorias['marca'])
+            for nivel, colunas in self.colunas.items()
+        }
+        # tipo_motor -> models containing the cylinders (few distinct selections, computed on demand)
+        self.modelos_tipo_motor = {}
+
+    @staticmethod
+    def chave(ano_ref, ano_fab):
+        return np.asarray(ano_ref, dtype='int64') * 100000 + np.asarray(ano_fab, dtype='int64')
+
+    def intervalo(self, nivel, ano_ref, ano_fab):
+        """
+        Returns the [inicio, fim) rows of the cube nivel ('marca' or 'modelo') for a year of reference and a year of manufacture
+        """
+        chave = self.chave(ano_ref, ano_fab)
+        inicio = np.searchsorted(self.chaves[nivel], chave, side='left')
+        fim = np.searchsorted(self.chaves[nivel], chave, side='right')
+        return inicio, fim
+
+    def posicoes(self, nivel, marcas, inicio, fim):
+        """
+        Returns the sorted row positions of the brands in marcas inside [inicio, fim)
+        """
+        indice_marcas = self.posicoes_marca[nivel]
+        posicoes = []
+        for marca in set(marcas):
+            posicoes_marca = indice_marcas.get(marca)
+            if posicoes_marca is not None:
+                esquerda, direita = np.searchsorted(posicoes_marca, [inicio, fim])
+                posicoes.append(posicoes_marca[esquerda:direita])
+        if not posicoes:
+            return np.empty(0, dtype='int64')
+        return np.sort(np.concatenate(posicoes))
+
+    def tabela_tipo_motor(self, tipo_motor):
+        """
+        Lookup table (by model code) of the models whose name contains any of the cylinders in tipo_motor
+        """
+        chave = tuple(sorted(tipo_motor))
+        if chave not in self.modelos_tipo_motor:
+            modelos = pd.Series(self.categorias['modelo'])
+            aceitos = np.zeros(len(modelos), dtype=bool)
+            for trecho in chave:
+                aceitos |= modelos.str.contains(trecho, regex=False).to_numpy()
+            self.modelos_tipo_motor[chave] = aceitos
+        return self.modelos_tipo_motor[chave]
+
+    def ranking(self, filtros):
+        """
+        Mean of 'valor' grouped by filtros.analise, with the same result of filtering and averaging the database
+        (with filtros.real, the mean of the prices adjusted by the deflator of the cube)
+        Empty selections (no fuel, no gear, no brand or no cylinder checked) don't filter anything
+        """
+        if filtros.analise == 'marca' and filtros.tipo_motor is None:
+            nivel = 'marca'
+        else:
+            nivel = 'modelo'
+        colunas = self.colunas[nivel]
+        inicio, fim = self.intervalo(nivel, filtros.ano_ref, filtros.ano_fab)
+
+        # marcas (exact match, through the brand -> positions index)
+        if filtros.marcas:
+            linhas = self.posicoes(nivel, filtros.marcas, inicio, fim)
+        else:
+            linhas = slice(inicio, fim)
+
+        codigos = colunas[filtros.analise][linhas]
+        mascara = codigos >= 0
+        if filtros.combustivel:
+            mascara &= pertence(colunas['combustivel'][linhas], self.categorias['combustivel'], filtros.combustivel)
+        if filtros.cambio:
+            mascara &= pertence(colunas['cambio'][linhas], self.categorias['cambio'], filtros.cambio)
+
+        if filtros.tam_motor is not None:
+            # bounds with the same precision of the column (float32 in the parquet database)
+            tam_motor = colunas['tam_motor'][linhas]
+            tam_motor_min, tam_motor_max = (tam_motor.dtype.type(tam) for tam in filtros.tam_motor)
+            mascara &= (tam_motor <= tam_motor_max) & (tam_motor >= tam_motor_min)
+
+        if filtros.tipo_motor:
+            mascara &= tabela(self.tabela_tipo_motor(filtros.tipo_motor), colunas['modelo'][linhas])
+
+        # re-aggregates the cube by category code: mean = sum of the sums / sum of the counts
+        soma, qntd = ('soma_real', 'qntd_real') if filtros.real else ('soma', 'qntd')
+        codigos = codigos[mascara]
+        categorias = self.categorias[filtros.analise]
+        soma = np.bincount(codigos, weights=colunas[soma][linhas][mascara], minlength=len(categorias))
+        qntd = np.bincount(codigos, weights=colunas[qntd][linhas][mascara], minlength=len(categorias))
+        observados = np.bincount(codigos, minlength=len(categorias)) > 0
+
+        result = pd.Series(
+            soma[observados] / qntd[observados],
+            index=pd.Index(categorias[observados], name=filtros.analise),
+            name='valor',
+        )
+        result = result.sort_values(ascending=filtros.decrescente)
+        return result.tail(filtros.qntd)
+
+
+# ------------------------ LOOKUPS OVER CATEGORY CODES ------------------------
+
+def indice(codigos, categorias):
+    """
+    Maps every category to the sorted positions of its rows, given the category codes of a column
+    """
+    ordem = np.argsort(codigos, kind='stable')
+    limites = np.searchsorted(codigos[ordem], np.arange(len(categorias) + 1))
+    return {
+        categoria: ordem[limites[codigo]:limites[codigo + 1]]
+        for codigo, categoria in enumerate(categorias)
+    }
+
+def tabela(aceitas, codigos):
+    """
+    Looks up category codes in a boolean table indexed by code (code -1, missing values, is never accepted)
+    """
+    return np.append(aceitas, False)[codigos]
+
+def pertence(codigos, categorias, valores):
+    """
+    Exact membership in valores, over the category codes of a column
+    """
+    return tabela(categorias.isin(list(valores)), codigos)
@@ -0,0 +1,131 @@
+import io
+import hashlib
+import matplotlib
+import matplotlib.style
+import pandas as pd
+import plotly.express as px
+import workers
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from cache import LRUCache
+
+# rendering of the plots of the app (matplotlib pngs and the interactive plotly figure)
+# every plot is drawn on its own Figure with the Agg canvas (no pyplot: no implicit global figure, so
+# concurrent renders don't draw over each other) and the png bytes are cached by the hash of the plotted
+# data, so the plot shown in the page and its download share the same render, across all sessions.
+# the renders run in the worker pool (see workers.py); the cache lives in the app process
+
+COR_BARRA = '#e64729'
+COR_GRADE = '#494949'
+TAMANHO = (10, 4)
+
+TEMA = {
+    'axes.facecolor': '#1e1e1e',
+    'axes.edgecolor': '#f4f4f4',
+    'axes.labelcolor': '#f4f4f4',
+    'xtick.color': '#f4f4f4',
+    'ytick.color': '#f4f4f4',
+    'grid.color': COR_GRADE,
+    'text.color': '#f4f4f4',
+    'figure.facecolor': '#1e1e1e',
+    'figure.edgecolor': '#1e1e1e',
+    'savefig.facecolor': '#1e1e1e',
+    'savefig.edgecolor': '#1e1e1e'
+}
+
+# the theme is applied once, when the module is imported
+matplotlib.style.use('dark_background')
+matplotlib.rcParams.update(TEMA)
+
+# hash of the plotted data -> png bytes
+png_cache = LRUCache(maxsize=128)
+
+
+def hash_dados(*partes):
+    """
+    Digest of everything drawn in a plot (series/dataframes are hashed with their index)
+    """
+    sha = hashlib.sha1()
+    for parte in partes:
+        if isinstance(parte, (pd.Series, pd.DataFrame)):
+            sha.update(pd.util.hash_pandas_object(parte).to_numpy().tobytes())
+        else:
+            sha.update(repr(parte).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def barras_horizontais(y, x, title, ylabel, yticks=None):
+    """
+    Png of the horizontal bar plot used by the app
+    """
+    fig = Figure(figsize=TAMANHO)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.set_title(title)
+    ax.barh(y, x, color=COR_BARRA)
+    ax.set_xlabel('valor')
+    ax.set_ylabel(ylabel)
+    if yticks is not None:
+        ax.set_yticks(yticks)
+    ax.xaxis.grid(True, color=COR_GRADE)
+
+    with io.BytesIO() as buf:
+        fig.savefig(buf, format='png')
+        return buf.getvalue()
+
+
+async def ranking_png(result, title, analise):
+    """
+    Png of the 'Ranking de Valores' plot
+    """
+    chave = ('ranking', hash_dados(result, title, analise))
+    return await png_cache.get_or_compute_async(
+        chave, lambda: workers.executar(barras_horizontais, result.index, result.values, title, analise)
+    )
+
+
+def sem_dados(title):
+    """
+    Png of an empty plot with a message, for when there is nothing to draw
+    """
+    fig = Figure(figsize=TAMANHO)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.set_title(title)
+    ax.set_axis_off()
+    ax.text(0.5, 0.5, 'sem dados para os filtros selecionados', ha='center', va='center')
+
+    with io.BytesIO() as buf:
+        fig.savefig(buf, format='png')
+        return buf.getvalue()
+
+
+def render_historico(result, modelo_nome):
+    if result.empty:
+        return sem_dados(modelo_nome)
+    yticks = range(int(min(result['ano_ref'])), int(max(result['ano_ref'])) + 1)
+    return barras_horizontais(result['ano_ref'], result['valor'], modelo_nome, 'ano ref.', yticks)
+
+
+async def historico_png(result, modelo_nome):
+    """
+    Png of the 'Histórico Modelo Individual' plot
+    """
+    chave = ('historico', hash_dados(result, modelo_nome))
+    return await png_cache.get_or_compute_async(chave, lambda: workers.executar(render_historico, result, modelo_nome))
+
+
+def ranking_interativo(result):
+    """
+    Interactive (plotly) version of the 'Ranking de Valores' plot
+    """
+    fig = px.bar(result, y=result.index, x=result.values, orientation='h',
+                title="Plot Interativo",
+                color_discrete_sequence=[COR_BARRA])
+    fig.update_layout(
+        plot_bgcolor='#1e1e1e',
+        paper_bgcolor='#1e1e1e',
+        font_color='#f4f4f4'
+    )
+    return fig
@@ -0,0 +1,13 @@
+# options of the 'Por Veículo' dropdown: ano_fab -> models of the latest year of reference
+
+
+def modelos_por_ano_fab(df):
+    """
+    Models of the latest year of reference in df, by ano_fab (indexed by their position in df)
+    """
+    ano_ref = df['ano_ref'].to_numpy()
+    atual = ano_ref == ano_ref.max()
+    modelos_atual = df['modelo'][atual].astype(str)
+    return {
+        int(ano): modelos for ano, modelos in modelos_atual.groupby(df['ano_fab'].to_numpy()[atual])
+    }
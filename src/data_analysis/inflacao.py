@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+# inflation adjustment of the prices shown by the app ('valores corrigidos pelo IPCA')
+# the deflator table (ipca.csv) is shipped with the app: each row is the IPCA variation of a period ending
+# at (ano, mes), accumulated into an index. A price of (ano_ref, mes_ref) is brought to reais of the last
+# period of the table with the index of the latest period closed at or before it (e.g. january/2010 uses
+# december/2009), so the factors of a whole column come from a single searchsorted
+
+path_to_ipca = Path(__file__).parent / "ipca.csv"
+
+MESES_ABREV = ['jan', 'fev', 'mar', 'abr', 'mai', 'jun', 'jul', 'ago', 'set', 'out', 'nov', 'dez']
+
+
+class Deflator:
+
+    def __init__(self, path=path_to_ipca):
+        tabela = pd.read_csv(path, sep=';', comment='#').sort_values(['ano', 'mes'])
+        self.periodos = periodo(tabela['ano'], tabela['mes'])
+        self.indices = np.cumprod(1 + tabela['variacao'].to_numpy() / 100)
+        ano, mes = divmod(int(self.periodos[-1]), 12)
+        # period of the reais of the adjusted prices, e.g. 'dez/2023'
+        self.base = f'{MESES_ABREV[mes]}/{ano}'
+
+    def fatores(self, ano_ref, mes_ref):
+        """
+        Multipliers that bring the prices of (ano_ref, mes_ref) to reais of the base
+        (nan for periods before the table, 1 after its end)
+        """
+        posicoes = np.searchsorted(self.periodos, periodo(ano_ref, mes_ref), side='right') - 1
+        fatores = self.indices[-1] / self.indices[np.maximum(posicoes, 0)]
+        return np.where(posicoes >= 0, fatores, np.nan)
+
+    def deflaciona(self, df):
+        """
+        'valor' of df (with ano_ref and mes_ref) in reais of the base
+        """
+        return df['valor'].to_numpy() * self.fatores(df['ano_ref'], df['mes_ref'])
+
+
+def periodo(ano, mes):
+    # months since year 0, so periods are ordered integers
+    return np.asarray(ano, dtype='int64') * 12 + np.asarray(mes, dtype='int64') - 1
@@ -0,0 +1,204 @@
+import os
+import json
+import pandas as pd
+import numpy as np
+from pathlib import Path
+import binarios
+from series import SeriesStore
+from cache import LRUCache
+from metadados import database_metadata
+
+# loads the database used by the app
+# the normalized database (data/normalized, written by create_database.py) is preferred: the vehicles are stored
+# once and joined to the narrow table of prices only for the requested columns, ano_ref partitions and vehicles.
+# next comes the columnar database (data/database.parquet): only the requested columns and ano_ref partitions are read from disk.
+# next come the binaries of the search app (bin/sequencial.bin, memory-mapped by binarios.py)
+# and data/database.csv is the last fallback
+# FIPE_DATA=<dir> points the app to another data directory (e.g. the synthetic ones of benchmark.py)
+
+path_to_data = Path(os.environ.get('FIPE_DATA', Path(__file__).parent.parent.parent / "data"))
+path_to_parquet = path_to_data / "database.parquet"
+path_to_csv = path_to_data / "database.csv"
+path_to_metadata = path_to_data / "metadata.json"
+path_to_series = path_to_data / "series"
+path_to_normalized = path_to_data / "normalized"
+path_to_veiculos = path_to_normalized / "veiculos.parquet"
+path_to_precos = path_to_normalized / "precos.parquet"
+path_to_sequencial = binarios.path_to_bin / "sequencial.bin"
+
+# columns used by the app
+COLUNAS_APP = ['ano_ref', 'marca', 'modelo', 'ano_fab', 'valor', 'combustivel', 'cambio', 'tam_motor']
+
+# columns stored as categoricals in memory (few distinct values repeated in every row)
+COLUNAS_CATEGORICAS = ['marca', 'modelo', 'combustivel', 'cambio']
+
+# columns of the fact table of the normalized database (the others come from the vehicle dimension)
+COLUNAS_PRECOS = ['ano_ref', 'mes_ref', 'valor']
+
+# vehicle dimension of the normalized database, kept while its file doesn't change
+veiculos_cache = LRUCache(maxsize=1)
+
+# FIPE_MEMORIA=1 prints the memory of every frame loaded by the app, before and after compact_frame
+RELATORIO_MEMORIA = os.environ.get('FIPE_MEMORIA', '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def load_database(colunas=COLUNAS_APP, anos_ref=None, filtros=None, verbose=None):
+    """
+    Returns the database with only the columns in colunas
+    If anos_ref is given, only these years of reference are loaded (predicate pushdown in the parquet)
+    filtros: optional [(coluna, valor)] equalities that every row must match, e.g. [('modelo', 'Gol 1.0')]
+    verbose: print the memory report of compact_frame (default: FIPE_MEMORIA)
+    """
+    if verbose is None:
+        verbose = RELATORIO_MEMORIA
+    filtros = list(filtros or [])
+    if normalized_exists():
+        df = read_normalized(colunas, anos_ref, filtros)
+    elif path_to_parquet.exists():
+        df = read_parquet(colunas, anos_ref, filtros)
+    elif path_to_sequencial.exists():
+        df = read_binarios(colunas, anos_ref, filtros)
+    else:
+        df = read_csv(colunas, anos_ref, filtros)
+    return compact_frame(df, verbose)
+
+
+def normalized_exists():
+    # the dimension is written last, after the parquet it is built from
+    if not path_to_veiculos.exists():
+        return False
+    return not path_to_parquet.exists() or path_to_veiculos.stat().st_mtime >= path_to_parquet.stat().st_mtime
+
+
+def load_veiculos():
+    """
+    Vehicle dimension of the normalized database (vehicle_id is the row number)
+    """
+    mtime = path_to_veiculos.stat().st_mtime
+    return veiculos_cache.get_or_compute(mtime, lambda: pd.read_parquet(path_to_veiculos))
+
+
+def read_normalized(colunas, anos_ref, filtros):
+    veiculos = load_veiculos()
+    predicados = [(coluna, '==', valor) for coluna, valor in filtros if coluna in COLUNAS_PRECOS]
+    if anos_ref is not None:
+        predicados.append(('ano_ref', 'in', [int(ano) for ano in anos_ref]))
+
+    # filters over the vehicles become a filter over vehicle_id, pushed down to the fact table
+    filtros_veiculo = [(coluna, valor) for coluna, valor in filtros if coluna not in COLUNAS_PRECOS]
+    if filtros_veiculo:
+        selecionados = np.ones(len(veiculos), dtype=bool)
+        for coluna, valor in filtros_veiculo:
+            selecionados &= (veiculos[coluna] == valor).to_numpy()
+        predicados.append(('vehicle_id', 'in', np.flatnonzero(selecionados).tolist()))
+
+    precos = pd.read_parquet(
+        path_to_precos,
+        columns=['vehicle_id'] + [coluna for coluna in colunas if coluna in COLUNAS_PRECOS],
+        filters=predicados or None,
+    )
+    ids = precos['vehicle_id'].to_numpy()
+
+    # lazy join: only the requested columns of the dimension are gathered, for the rows that were read
+    df = pd.DataFrame(index=pd.RangeIndex(len(precos)))
+    for coluna in colunas:
+        if coluna == 'ano_ref':
+            # partition column comes back as a categorical of the directory names
+            df[coluna] = precos[coluna].astype('int64').to_numpy()
+        elif coluna in COLUNAS_PRECOS:
+            df[coluna] = precos[coluna].to_numpy()
+        else:
+            df[coluna] = veiculos[coluna].take(ids).reset_index(drop=True)
+    return df
+
+
+def read_parquet(colunas, anos_ref, filtros):
+    predicados = [(coluna, '==', valor) for coluna, valor in filtros]
+    if anos_ref is not None:
+        predicados.append(('ano_ref', 'in', [int(ano) for ano in anos_ref]))
+    df = pd.read_parquet(path_to_parquet, columns=list(colunas), filters=predicados or None)
+    if 'ano_ref' in df.columns:
+        # partition column comes back as a categorical of the directory names
+        df['ano_ref'] = df['ano_ref'].astype('int64')
+    return df[list(colunas)]
+
+
+def read_binarios(colunas, anos_ref, filtros):
+    carros = binarios.load_sequencial(path_to_sequencial)
+    if anos_ref is not None:
+        carros = carros[np.isin(carros['ano_ref'], [int(ano) for ano in anos_ref])]
+    return filtra(binarios.sequencial_to_df(carros), filtros)[list(colunas)]
+
+
+def read_csv(colunas, anos_ref, filtros):
+    usecols = set(colunas) | {coluna for coluna, _ in filtros}
+    if anos_ref is not None:
+        usecols.add('ano_ref')
+    df = pd.read_csv(path_to_csv, sep=';', usecols=list(usecols))
+    if anos_ref is not None:
+        df = df[df['ano_ref'].isin([int(ano) for ano in anos_ref])]
+    return filtra(df, filtros)[list(colunas)]
+
+
+def filtra(df, filtros):
+    for coluna, valor in filtros:
+        df = df[df[coluna] == valor]
+    return df.reset_index(drop=True)
+
+
+def load_metadata():
+    """
+    Bounds and distinct values used to build the UI of the app, from data/metadata.json (written by create_database.py)
+    When the file doesn't exist or is older than the database they are computed from it (a scan of a few columns)
+    """
+    fonte = database_source()
+    if path_to_metadata.exists() and path_to_metadata.stat().st_mtime >= fonte.stat().st_mtime:
+        with open(path_to_metadata, encoding='utf-8') as file:
+            return json.load(file)
+    return database_metadata(load_database(['ano_ref', 'ano_fab', 'marca', 'tam_motor'], verbose=False))
+
+
+def database_source():
+    """
+    File (or directory) that load_database reads from
+    """
+    if normalized_exists():
+        return path_to_veiculos
+    return next(path for path in (path_to_parquet, path_to_sequencial, path_to_csv) if path.exists())
+
+
+def load_series():
+    """
+    Price series of every vehicle, memory-mapped from data/series (written by create_database.py)
+    None when they don't exist or are older than the database: the app then reads the histories from the database
+    """
+    info = path_to_series / "series.json"
+    if not path_to_parquet.exists() or not info.exists() or info.stat().st_mtime < path_to_parquet.stat().st_mtime:
+        return None
+    return SeriesStore(path_to_series)
+
+
+def compact_frame(df, verbose=True):
+    """
+    Shrinks the dataframe kept in memory by the app:
+    text columns become categoricals and numeric columns are downcast to the narrowest type
+    that holds all their values exactly (floats only become float32 when no value changes)
+    """
+    antes = df.memory_usage(deep=True).sum()
+
+    df = df.copy()
+    for coluna in df.columns:
+        if coluna in COLUNAS_CATEGORICAS:
+            if not isinstance(df[coluna].dtype, pd.CategoricalDtype):
+                df[coluna] = df[coluna].astype('category')
+        elif pd.api.types.is_integer_dtype(df[coluna].dtype):
+            df[coluna] = pd.to_numeric(df[coluna], downcast='integer')
+        elif pd.api.types.is_float_dtype(df[coluna].dtype) and df[coluna].dtype != np.float32:
+            float32 = df[coluna].astype('float32')
+            if np.array_equal(float32.to_numpy(dtype='float64'), df[coluna].to_numpy(), equal_nan=True):
+                df[coluna] = float32
+
+    if verbose:
+        depois = df.memory_usage(deep=True).sum()
+        print(f'database in memory: {antes / 2**20:.1f} MiB -> {depois / 2**20:.1f} MiB ({len(df)} rows)')
+    return df
@@ -0,0 +1,40 @@
+import numpy as np
+
+# bounds and distinct values used to build the UI of the app (data/metadata.json)
+# computed by create_database.py when it writes the database, and by the app itself when the file is missing or stale,
+# so both use these functions
+
+
+def ordem_marca(marca):
+    return (marca.lower(), marca)
+
+
+def database_metadata(df):
+    """
+    Metadata of the rows of df (columns ano_ref, ano_fab, marca and tam_motor)
+    """
+    return {
+        'linhas': len(df),
+        'anos_ref': sorted(int(ano) for ano in df['ano_ref'].unique()),
+        'ano_fab_min': int(df['ano_fab'].min()),
+        'tam_motor_min': round(float(df['tam_motor'].min()), 1),
+        'tam_motor_max': round(float(df['tam_motor'].max()), 1),
+        'marcas': sorted(df['marca'].astype(str).unique(), key=ordem_marca),
+    }
+
+
+def merge_metadata(a, b):
+    """
+    Metadata of the rows of a and b together (used by the streaming mode of create_database.py, one chunk at a time)
+    """
+    if a is None:
+        return b
+    return {
+        'linhas': a['linhas'] + b['linhas'],
+        'anos_ref': sorted(set(a['anos_ref']) | set(b['anos_ref'])),
+        'ano_fab_min': min(a['ano_fab_min'], b['ano_fab_min']),
+        # fmin/fmax skip the nan of chunks without any engine size
+        'tam_motor_min': float(np.fmin(a['tam_motor_min'], b['tam_motor_min'])),
+        'tam_motor_max': float(np.fmax(a['tam_motor_max'], b['tam_motor_max'])),
+        'marcas': sorted(set(a['marcas']) | set(b['marcas']), key=ordem_marca),
+    }
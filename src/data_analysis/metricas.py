@@ -0,0 +1,174 @@
+import os
+import time
+import bisect
+import asyncio
+import threading
+from contextlib import contextmanager
+from starlette.responses import JSONResponse
+
+# opt-in instrumentation of the hot paths of the app (ranking, plots, dropdown search, plate lookup)
+#   FIPE_METRICAS=1 records the latency histograms, row counts and cache stats, served as json by GET /metricas
+#   FIPE_METRICAS_LOG=<seconds> also prints a summary line every <seconds>
+# when disabled (default) medir() only yields, nothing is recorded.
+# the timings are taken in the app process around the awaited work, so in FIPE_POOL=process they include
+# the round trip to the worker, and the caches filled inside the workers are not seen here
+
+INTERVALO_LOG = float(os.environ.get('FIPE_METRICAS_LOG', 0))
+# FIPE_METRICAS=0/false/no (or empty) keeps it disabled
+ATIVO = os.environ.get('FIPE_METRICAS', '').strip().lower() in ('1', 'true', 'yes', 'on') or INTERVALO_LOG > 0
+
+# upper bounds (ms) of the latency buckets, the last bucket has no bound
+LIMITES = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+inicio_processo = time.monotonic()
+lock = threading.Lock()
+histogramas = {}    # name of the measured step -> Histograma
+caches = {}         # name -> LRUCache
+
+
+class Histograma:
+    """
+    Latency histogram (fixed buckets, in ms) of a step, with the total of rows it handled
+    """
+
+    def __init__(self):
+        self.contagens = [0] * (len(LIMITES) + 1)
+        self.n = 0
+        self.soma = 0.0
+        self.maximo = 0.0
+        self.linhas = None      # only for the steps that report their rows
+        self.erros = 0
+        self.cancelados = 0
+
+    def observa(self, ms, linhas=None):
+        self.contagens[bisect.bisect_left(LIMITES, ms)] += 1
+        self.n += 1
+        self.soma += ms
+        self.maximo = max(self.maximo, ms)
+        if linhas is not None:
+            self.linhas = (self.linhas or 0) + linhas
+
+    def quantil(self, q):
+        """
+        Upper bound of the bucket where the quantile q falls (the max for the last bucket)
+        """
+        alvo = q * self.n
+        acumulado = 0
+        for limite, contagem in zip(LIMITES, self.contagens):
+            acumulado += contagem
+            if acumulado >= alvo:
+                return min(limite, self.maximo)
+        return self.maximo
+
+    def resumo(self):
+        resumo = {'n': self.n, 'erros': self.erros, 'cancelados': self.cancelados}
+        if self.linhas is not None:
+            resumo['linhas'] = self.linhas
+        if self.n:
+            resumo.update(
+                media_ms=round(self.soma / self.n, 2),
+                p50_ms=round(self.quantil(0.5), 2),
+                p95_ms=round(self.quantil(0.95), 2),
+                p99_ms=round(self.quantil(0.99), 2),
+                max_ms=round(self.maximo, 2),
+            )
+        limites = [f'<={limite}' for limite in LIMITES] + [f'>{LIMITES[-1]}']
+        resumo['buckets_ms'] = dict(zip(limites, self.contagens))
+        return resumo
+
+
+class Medida:
+    """
+    Yielded by medir(): the measured code may set the number of rows it handled
+    """
+    linhas = None
+
+
+def histograma(nome):
+    # caller holds the lock
+    if nome not in histogramas:
+        histogramas[nome] = Histograma()
+    return histogramas[nome]
+
+
+@contextmanager
+def medir(nome):
+    """
+    Records the latency of the block (sync or async code) in the histogram nome.
+    Exceptions count as errors, and cancellations (superseded extended tasks) are counted apart
+    """
+    medida = Medida()
+    if not ATIVO:
+        yield medida
+        return
+    inicio = time.perf_counter()
+    try:
+        yield medida
+    except asyncio.CancelledError:
+        with lock:
+            histograma(nome).cancelados += 1
+        raise
+    except BaseException:
+        with lock:
+            histograma(nome).erros += 1
+        raise
+    else:
+        ms = (time.perf_counter() - inicio) * 1000
+        with lock:
+            histograma(nome).observa(ms, medida.linhas)
+
+
+def registra_cache(nome, cache):
+    caches[nome] = cache
+
+
+def snapshot():
+    with lock:
+        latencias = {nome: hist.resumo() for nome, hist in histogramas.items()}
+    stats = {}
+    for nome, cache in caches.items():
+        stats[nome] = cache.stats()
+        consultas = stats[nome]['hits'] + stats[nome]['misses']
+        stats[nome]['hit_ratio'] = round(stats[nome]['hits'] / consultas, 3) if consultas else None
+    return {
+        'pid': os.getpid(),
+        'uptime_s': round(time.monotonic() - inicio_processo, 1),
+        'latencias': latencias,
+        'caches': stats,
+    }
+
+
+def linha():
+    """
+    One line summary, e.g. 'ranking_data n=12 p50=5ms p95=50ms | ranking_cache 8/12 hits'
+    """
+    dados = snapshot()
+    partes = []
+    for nome, resumo in dados['latencias'].items():
+        parte = f"{nome} n={resumo['n']}"
+        if resumo['n']:
+            parte += f" p50={resumo['p50_ms']:g}ms p95={resumo['p95_ms']:g}ms"
+        if resumo['erros']:
+            parte += f" erros={resumo['erros']}"
+        partes.append(parte)
+    partes += [
+        f"{nome} {stats['hits']}/{stats['hits'] + stats['misses']} hits"
+        for nome, stats in dados['caches'].items()
+    ]
+    return 'metricas: ' + (' | '.join(partes) or 'nothing recorded')
+
+
+async def endpoint(request):
+    return JSONResponse(snapshot())
+
+
+def inicia_log():
+    """
+    Prints linha() every INTERVALO_LOG seconds (daemon thread, dies with the app)
+    """
+    def loop():
+        while True:
+            time.sleep(INTERVALO_LOG)
+            print(linha(), flush=True)
+
+    threading.Thread(target=loop, name='fipe-metricas', daemon=True).start()
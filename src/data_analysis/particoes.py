@@ -0,0 +1,42 @@
+import loader
+from cache import LRUCache
+
+# lazy access to the database used by the app
+# most views touch a single ano_ref (ranking) or a single model (history), so instead of loading every
+# year at startup, each view reads only the partition/rows and the columns it needs on first use.
+# the frames are kept in an LRU bounded by their memory
+
+
+def tamanho_frame(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+class Particoes:
+
+    def __init__(self, maxbytes=256 * 2**20):
+        self.cache = LRUCache(maxsize=256, maxbytes=maxbytes, tamanho=tamanho_frame)
+
+    def ano(self, ano_ref, colunas=loader.COLUNAS_APP):
+        """
+        Returns the rows of a year of reference, with only the columns in colunas
+        """
+        ano_ref = int(ano_ref)
+        colunas = tuple(colunas)
+        return self.cache.get_or_compute(
+            ('ano', ano_ref, colunas),
+            lambda: loader.load_database(colunas, anos_ref=[ano_ref]),
+        )
+
+    def historico(self, modelo, ano_fab):
+        """
+        Returns the price history (ano_ref, mes_ref, valor) of a model made in ano_fab, every price of the model name
+        sorted by ano_ref, mes_ref and valor (read from every partition, with the model and the year pushed down to
+        the reader)
+        """
+        ano_fab = int(ano_fab)
+
+        def carrega():
+            df = loader.load_database(['ano_ref', 'mes_ref', 'valor'], filtros=[('modelo', modelo), ('ano_fab', ano_fab)])
+            return df.sort_values(['ano_ref', 'mes_ref', 'valor'], ignore_index=True)
+
+        return self.cache.get_or_compute(('historico', modelo, ano_fab), carrega)
@@ -0,0 +1,162 @@
+import os
+import re
+import asyncio
+import httpx
+from pathlib import Path
+from typing import NamedTuple
+from bs4 import BeautifulSoup
+from cache import LRUCache
+
+# plate search used in the 'Por Placa' tab
+# the page of the plate in placafipe.com is fetched asynchronously (the event loop keeps serving the other
+# sessions meanwhile) by a connection-pooled client with timeout and retries, and the parsed result is kept
+# in a bounded TTL cache keyed by the normalized plate.
+# the backend is pluggable: setting FIPE_PLACA_STUB=<dir> reads the pages from <dir>/<PLACA>.html instead
+# (for testing without network)
+
+URL_PLACA = 'https://placafipe.com/placa/{placa}'
+
+# brazilian plates: ABC1234 or ABC1D23 (mercosul)
+PADRAO_PLACA = re.compile(r"[A-Z]{3}\d([A-Z]|\d)\d{2}")
+
+
+class PlacaInvalida(Exception):
+    pass
+
+class PlacaNaoEncontrada(Exception):
+    """
+    The site answered, but has no vehicle for the plate (the message is the site's notice)
+    """
+    pass
+
+class ErroConsulta(Exception):
+    """
+    The site could not be reached (timeout, connection error, unexpected status...)
+    """
+    pass
+
+
+class Placa(NamedTuple):
+    modelos: list       # names of the models that may have the plate
+    ano_modelo: int     # year of the model
+
+
+def normaliza_placa(placa):
+    """
+    'abc-1d23 ' -> 'ABC1D23', raises PlacaInvalida if it is not a plate
+    """
+    placa = (placa or '').strip().upper().replace('-', '')
+    if not PADRAO_PLACA.fullmatch(placa):
+        raise PlacaInvalida(placa)
+    return placa
+
+
+def parse_pagina(html):
+    """
+    Extracts the models and the year of the model from the page of a plate in placafipe.com
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    aviso_placa_nao_encontrada = soup.select_one('.template-middle > div:nth-child(1) > p:nth-child(2)')
+    if aviso_placa_nao_encontrada is not None:
+        raise PlacaNaoEncontrada(aviso_placa_nao_encontrada.text)
+
+    tabela = soup.select_one('.fipe-desktop')
+    detalhes = soup.select_one('.fipeTablePriceDetail')
+    if tabela is None or detalhes is None:
+        raise ErroConsulta('unexpected page layout')
+
+    try:
+        modelos = [linha.find_all('td')[1].text for linha in tabela.find_all('tr')[1:]]
+        ano_modelo = int(detalhes.find_all('tr')[5].find_all('td')[1].text)
+    except (IndexError, ValueError) as e:
+        # changed or partial page
+        raise ErroConsulta(f'unexpected page layout ({e})') from e
+    return Placa(modelos, ano_modelo)
+
+
+# ------------------------ BACKENDS ------------------------
+
+class HttpBackend:
+    """
+    Fetches the pages from placafipe.com with a pooled async http client
+    """
+
+    def __init__(self, url=URL_PLACA, timeout=10.0, tentativas=3):
+        self.url = url
+        self.timeout = timeout
+        self.tentativas = tentativas
+        self.client = None
+
+    async def pagina(self, placa):
+        if self.client is None:
+            # created lazily, inside the event loop of the app
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                headers={'User-Agent': 'Mozilla/5.0'},
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+                follow_redirects=True,
+            )
+
+        erro = None
+        for tentativa in range(self.tentativas):
+            try:
+                resposta = await self.client.get(self.url.format(placa=placa))
+            except httpx.TransportError as e:
+                # timeouts and connection errors are retried with a small backoff
+                erro = e
+                if tentativa < self.tentativas - 1:
+                    await asyncio.sleep(0.5 * (tentativa + 1))
+                continue
+            if resposta.status_code != 200:
+                raise ErroConsulta(f'status {resposta.status_code}')
+            return resposta.text
+        raise ErroConsulta(repr(erro))
+
+
+class StubBackend:
+    """
+    Reads the pages from a local directory (<diretorio>/<PLACA>.html), for testing without network
+    """
+
+    def __init__(self, diretorio):
+        self.diretorio = Path(diretorio)
+
+    async def pagina(self, placa):
+        arquivo = self.diretorio / f'{placa}.html'
+        if not arquivo.exists():
+            raise ErroConsulta(f'{arquivo} not found')
+        return arquivo.read_text(encoding='utf-8')
+
+
+def backend_padrao():
+    """
+    StubBackend if FIPE_PLACA_STUB is set, otherwise HttpBackend
+    """
+    diretorio = os.environ.get('FIPE_PLACA_STUB')
+    if diretorio:
+        return StubBackend(diretorio)
+    return HttpBackend()
+
+
+# ------------------------ SERVICE ------------------------
+
+class PlacaService:
+
+    def __init__(self, backend=None, ttl=6 * 60 * 60, maxsize=1024):
+        self.backend = backend if backend is not None else backend_padrao()
+        # normalized plate -> Placa
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    async def buscar(self, placa):
+        """
+        Returns the Placa of a plate
+        Raises PlacaInvalida, PlacaNaoEncontrada or ErroConsulta
+        """
+        placa = normaliza_placa(placa)
+        resultado = self.cache.get(placa)
+        if resultado is None:
+            html = await self.backend.pagina(placa)
+            # parsing is cpu bound, so it runs outside the event loop
+            resultado = await asyncio.to_thread(parse_pagina, html)
+            self.cache.put(placa, resultado)
+        return resultado
@@ -0,0 +1,69 @@
+import time
+from shiny import reactive
+
+# reactive helpers of the app
+
+
+def debounce(segundos):
+    """
+    Decorator that turns a function of the inputs into a reactive calc that only changes after the inputs
+    stayed still for `segundos`: a burst of input changes (e.g. the animated ano_fab slider or the engine
+    size bounds updating each other) is coalesced into a single invalidation of what depends on it.
+    The first value is released right away, and a value equal (==) to the last one released is dropped.
+    An error of the function is released like a value and raised to the readers: an effect reading it has to
+    catch it, an error escaping an effect closes the session
+    """
+    def decorator(func):
+        prazo = reactive.Value(None)
+        # last released (value, error)
+        liberado = reactive.Value()
+
+        @reactive.Calc
+        def atual():
+            return func()
+
+        def libera():
+            try:
+                novo = (atual(), None)
+            except Exception as erro:
+                novo = (None, erro)
+            if not liberado.is_set() or novo != liberado.get():
+                liberado.set(novo)
+
+        # every change of the inputs pushes the deadline forward
+        @reactive.Effect(priority=102)
+        def _():
+            try:
+                atual()
+            except Exception:
+                pass
+            with reactive.isolate():
+                if liberado.is_set():
+                    prazo.set(time.monotonic() + segundos)
+                else:
+                    libera()
+
+        # when the deadline passes, the value is released
+        @reactive.Effect(priority=101)
+        def _():
+            limite = prazo()
+            if limite is None:
+                return
+            restante = limite - time.monotonic()
+            if restante > 0:
+                reactive.invalidate_later(restante)
+            else:
+                with reactive.isolate():
+                    prazo.set(None)
+                    libera()
+
+        @reactive.Calc
+        def debounced():
+            valor, erro = liberado()
+            if erro is not None:
+                raise erro
+            return valor
+
+        return debounced
+
+    return decorator
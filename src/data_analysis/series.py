@@ -0,0 +1,105 @@
+import json
+import numpy as np
+import pandas as pd
+
+# price series of every vehicle, written by create_database.py into data/series:
+# a series per vehicle and name with only its observed months (prices and months of every series one after the
+# other, and the position where each series starts), memory-mapped, so a history reads a few slices of it instead
+# of scanning the database, and the computations over every series at once are plain numpy operations over the
+# arrays (without a matrix of months: most vehicles are priced in a few months of the whole range)
+
+
+class SeriesStore:
+
+    def __init__(self, path):
+        with open(path / "series.json", encoding='utf-8') as file:
+            info = json.load(file)
+        # model name -> its series [inicio, fim)
+        self.modelos = info['modelos']
+        self.ano_ref_inicio = info['ano_ref_inicio']
+        self.precos = np.load(path / "precos.npy", mmap_mode='r')
+        # months since january of ano_ref_inicio
+        self.periodos = np.load(path / "periodos.npy", mmap_mode='r')
+        # series i is precos[inicio[i]:inicio[i + 1]]
+        self.inicio = np.load(path / "inicio.npy", mmap_mode='r')
+        # keys of the series, sorted by model name
+        self.codigo_fipe = np.load(path / "codigo_fipe.npy", mmap_mode='r')
+        self.ano_fab = np.load(path / "ano_fab.npy", mmap_mode='r')
+        self.combustivel = np.load(path / "combustivel.npy", mmap_mode='r')
+        self.marca = np.load(path / "marca.npy", mmap_mode='r')
+
+    def chaves(self):
+        """
+        Keys of the series (and of depreciacao_anual)
+        """
+        modelos = np.empty(len(self.codigo_fipe), dtype=object)
+        for modelo, (inicio, fim) in self.modelos.items():
+            modelos[inicio:fim] = modelo
+        return pd.DataFrame({'codigo_fipe': self.codigo_fipe, 'ano_fab': self.ano_fab, 'combustivel': self.combustivel,
+                             'marca': self.marca, 'modelo': modelos})
+
+    def series(self):
+        """
+        Series of each price (row of chaves), to group the per price computations
+        """
+        return np.repeat(np.arange(len(self.inicio) - 1), np.diff(self.inicio))
+
+    def linhas(self, modelo, ano_fab):
+        """
+        Series of a model made in ano_fab (one per fuel)
+        """
+        inicio, fim = self.modelos.get(modelo, (0, 0))
+        return inicio + np.flatnonzero(self.ano_fab[inicio:fim] == ano_fab)
+
+    def historico(self, modelo, ano_fab):
+        """
+        Returns the price history (ano_ref, mes_ref, valor) of a model made in ano_fab, every price of the model name
+        sorted by ano_ref, mes_ref and valor (same frame as Particoes.historico)
+        """
+        fatias = [slice(self.inicio[linha], self.inicio[linha + 1]) for linha in self.linhas(modelo, int(ano_fab))]
+        periodos = np.concatenate([self.periodos[fatia] for fatia in fatias] or [np.empty(0, dtype='int16')]).astype('int64')
+        precos = np.concatenate([self.precos[fatia] for fatia in fatias] or [np.empty(0, dtype='float32')])
+        ordem = np.lexsort((precos, periodos))
+        periodos = periodos[ordem]
+        return pd.DataFrame({'ano_ref': self.ano_ref_inicio + periodos // 12, 'mes_ref': periodos % 12 + 1, 'valor': precos[ordem]})
+
+    def variacao(self, meses=12):
+        """
+        Percent change of every price against the price of the same series `meses` months before
+        (nan when that month has no price)
+        """
+        if int(meses) < 1:
+            raise ValueError(f'meses must be at least 1, got {meses}')
+        # position of each price in the sorted (series, month) keys, and of the price `meses` months before it
+        chave = self.series() * 2**16 + np.asarray(self.periodos, dtype='int64')
+        anterior = np.searchsorted(chave, chave - int(meses))
+        encontrado = anterior < len(chave)
+        encontrado[encontrado] = chave[anterior[encontrado]] == chave[encontrado] - int(meses)
+        precos = np.asarray(self.precos, dtype='float64')
+        base = np.where(encontrado, precos[np.minimum(anterior, len(precos) - 1)], np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(base > 0, (precos / base - 1) * 100, np.nan).astype('float32')
+
+    def depreciacao(self):
+        """
+        Percent of the first price of its series lost at every price (nan when the first price is zero)
+        """
+        precos = np.asarray(self.precos, dtype='float64')
+        primeiro = precos[np.asarray(self.inicio)[self.series()]]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(primeiro > 0, (1 - precos / primeiro) * 100, np.nan).astype('float32')
+
+    def depreciacao_anual(self):
+        """
+        Mean yearly depreciation (%) of every series, between its first and last prices
+        (nan for the series priced in a single month)
+        """
+        contagem = np.diff(self.inicio)
+        # first and last price of each series (the empty ones point at their neighbours and are masked below)
+        primeiro = np.minimum(self.inicio[:-1], len(self.precos) - 1)
+        ultimo = np.maximum(self.inicio[1:] - 1, 0)
+        anos = (self.periodos[ultimo].astype('int64') - self.periodos[primeiro]) / 12
+        anos[contagem == 0] = 0
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            razao = self.precos[ultimo].astype('float64') / self.precos[primeiro]
+            return np.where((anos > 0) & (razao > 0), (1 - razao ** (1 / np.where(anos > 0, anos, 1))) * 100, np.nan)
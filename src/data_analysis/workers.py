@@ -0,0 +1,58 @@
+import os
+import signal
+import asyncio
+import threading
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# pool that runs the heavy work of the app (aggregations and plot rendering) outside the event loop,
+# so a slow ranking or render of one session doesn't stall the others
+#   FIPE_POOL=thread (default) | process
+#   FIPE_POOL_WORKERS=<n> (default: number of cpus, at most 4)
+# in the process mode the workers are forked from the app after the database is loaded, so the functions
+# sent to the pool must be module level functions (pickled by name) that read the module level indexes
+
+MODO = os.environ.get('FIPE_POOL', 'thread')
+WORKERS = int(os.environ.get('FIPE_POOL_WORKERS', min(os.cpu_count() or 1, 4)))
+
+pool = None
+
+
+def inicia_processo():
+    """
+    Forked workers must not inherit the signal handlers of the web server (they would ignore SIGTERM),
+    and exit with the app even when it is killed without shutting the pool down
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def espera_app():
+        multiprocessing.connection.wait([multiprocessing.parent_process().sentinel])
+        os._exit(0)
+
+    threading.Thread(target=espera_app, daemon=True).start()
+
+
+def get_pool():
+    """
+    Created lazily, on the first task (after every module level index of the app exists)
+    """
+    global pool
+    if pool is None:
+        if MODO == 'process':
+            pool = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context('fork'), initializer=inicia_processo)
+        elif MODO == 'thread':
+            pool = ThreadPoolExecutor(WORKERS, thread_name_prefix='fipe')
+        else:
+            raise ValueError(f"FIPE_POOL must be 'thread' or 'process', not {MODO!r}")
+    return pool
+
+
+async def executar(func, *args):
+    """
+    Runs func(*args) in the pool. If the awaiting task is cancelled (superseded request),
+    the work is dropped from the queue when it didn't start yet
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pool(), func, *args)